@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Drives dl621 end to end against the local mock e621 and reports throughput
+
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import dl621
+from dl621 import core
+
+MOCK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_e621.py")
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+def make_report(name, posts, total_bytes, elapsed, latencies, peak_rss_mb):
+    return {
+        "scenario": name,
+        "posts": posts,
+        "seconds": round(elapsed, 3),
+        "posts_per_sec": round(posts / elapsed, 1) if elapsed > 0 else 0.0,
+        "mb_per_sec": round(total_bytes / (1024 * 1024) / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "peak_rss_mb": round(peak_rss_mb, 1)
+    }
+
+class MockProcess:
+    # The mock runs in its own process, so its memory doesn't count towards dl621's peak RSS
+    def __init__(self, args):
+        command = [sys.executable, MOCK_SCRIPT, "--port", "0", "--posts", str(args.posts), "--file_size", str(args.file_size), "--latency", str(args.latency), "--file_latency", str(args.file_latency), "--error_rate", str(args.error_rate)]
+        if args.bandwidth != None:
+            command += ["--bandwidth", str(args.bandwidth)]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        match = re.search(r"(http://\S+)", line)
+        if match == None:
+            self.process.kill()
+            raise RuntimeError("Mock e621 did not start: {}".format(line))
+        self.base_url = match.group(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.terminate()
+        self.process.wait()
+
+def bench_api(client, args):
+    latencies = list()
+    posts = 0
+    total_bytes = 0
+    cursor = None
+    start = time.perf_counter()
+    while True:
+        call_start = time.perf_counter()
+        page = client.get_info_json_multiple(page=cursor, page_modifier="b" if cursor != None else None, limit=args.page_size)
+        latencies.append(time.perf_counter() - call_start)
+        if page == None or len(page) == 0:
+            break
+        posts += len(page)
+        total_bytes += len(json.dumps(page))
+        cursor = min(post["id"] for post in page)
+    return make_report("get_info_json_multiple", posts, total_bytes, time.perf_counter() - start, latencies, get_peak_rss_mb())
+
+def bench_download(client, posts, args):
+    output_folder = tempfile.mkdtemp(prefix="dl621_bench_")
+    latencies = list()
+
+    def timed_download(post):
+        call_start = time.perf_counter()
+        results = client.download_image(post["id"], custom_json=post, output_folder=output_folder, add_tags=args.add_tags)
+        latencies.append(time.perf_counter() - call_start)
+        return results
+
+    try:
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(timed_download, posts))
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+    saved = [post for post, r in zip(posts, results) if r["saved_image"]]
+    total_bytes = sum(post["file"]["size"] for post in saved)
+    return make_report("download_image", len(saved), total_bytes, elapsed, latencies, get_peak_rss_mb())
+
+def bench_cli(base_url, posts, args):
+    output_folder = tempfile.mkdtemp(prefix="dl621_bench_")
+    command = [sys.executable, "-c", "from dl621.core import run; run()", "--base_url", base_url, "--tags", "bench", "-l", str(len(posts)), "-f", output_folder, "-w", str(args.workers), "--api_rate", "1000"]
+    if not args.add_tags:
+        command.append("-t")
+
+    try:
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+        elapsed = time.perf_counter() - start
+        files = [name for name in os.listdir(output_folder) if not name.endswith(".part")]
+        total_bytes = sum(os.path.getsize(os.path.join(output_folder, name)) for name in files)
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+    return make_report("cli --tags", len(files), total_bytes, elapsed, [elapsed], get_peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+def print_reports(reports):
+    columns = ["scenario", "posts", "seconds", "posts_per_sec", "mb_per_sec", "p50_ms", "p99_ms", "peak_rss_mb"]
+    widths = [max(len(column), max(len(str(report[column])) for report in reports)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for report in reports:
+        print("  ".join(str(report[column]).ljust(width) for column, width in zip(columns, widths)))
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmarks dl621 against a local mock e621")
+    parser.add_argument("--posts", type=int, default=500, help="how many posts the mock serves")
+    parser.add_argument("--file_size", type=int, default=64 * 1024, help="average file size in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency for each API request")
+    parser.add_argument("--file_latency", type=float, default=0.0, help="seconds of latency before each file transfer")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second for each file transfer")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests that fail with a 503")
+    parser.add_argument("--page_size", type=int, default=dl621.__e621_posts_per_request_limit__)
+    parser.add_argument("--workers", type=int, default=dl621.__default_workers__)
+    parser.add_argument("--add_tags", action="store_true", help="embed XMP tags (needs Exempi)")
+    parser.add_argument("--scenarios", nargs="+", default=["api", "download", "cli"], choices=["api", "download", "cli"])
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the reports to a JSON file")
+    return parser.parse_args(args)
+
+def main(args):
+    args = parse_args(args)
+
+    reports = list()
+    with MockProcess(args) as mock:
+        client = core.Client(base_url=mock.base_url, api_rate_limit=None, pool_size=max(args.workers, core.__default_pool_size__))
+        posts = client.get_info_json_multiple(limit=min(args.posts, dl621.__e621_posts_per_request_limit__))
+
+        if "api" in args.scenarios:
+            reports.append(bench_api(client, args))
+        if "download" in args.scenarios:
+            reports.append(bench_download(client, posts, args))
+        if "cli" in args.scenarios:
+            reports.append(bench_cli(mock.base_url, posts, args))
+        client.close()
+
+    print_reports(reports)
+    if args.json_path != None:
+        with open(args.json_path, "w") as f:
+            json.dump(reports, f, indent=4)
+    return reports
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
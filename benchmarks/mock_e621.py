@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# A local stand-in for the e621 API and static file host, for benchmarks
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def make_png(seed, size):
+    def chunk(chunk_type, data):
+        return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    header = chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+    pixels = chunk(b"IDAT", zlib.compress(b"\x00" + bytes([seed % 256, (seed >> 8) % 256, (seed >> 16) % 256])))
+    end = chunk(b"IEND", b"")
+
+    # Pad with a text chunk to reach the requested size, seeded so every post has its own MD5
+    base_size = 8 + len(header) + len(pixels) + len(end) + 12 + 8
+    padding = random.Random(seed).randbytes(max(0, size - base_size))
+    text = chunk(b"tEXt", b"padding\x00" + padding)
+    return b"\x89PNG\r\n\x1a\n" + header + text + pixels + end
+
+class MockE621:
+    def __init__(self, posts=500, file_size=64 * 1024, file_size_jitter=0.5, latency=0.0, file_latency=0.0, bandwidth=None, error_rate=0.0, ranges=True, seed=621):
+        self.post_count = posts
+        self.file_size = file_size
+        self.file_size_jitter = file_size_jitter
+        self.latency = latency
+        self.file_latency = file_latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.ranges = ranges
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"api_requests": 0, "file_requests": 0, "file_bytes": 0, "errors": 0}
+
+        # Files are generated up front so request handling stays cheap
+        self.posts = dict()
+        self.files = dict()
+        for post_id in range(1, posts + 1):
+            size = int(file_size * (1 + file_size_jitter * (self.random.random() * 2 - 1)))
+            data = make_png(post_id, max(64, size))
+            md5 = hashlib.md5(data).hexdigest()
+            self.files[md5] = data
+            self.posts[post_id] = self._make_post(post_id, md5, len(data))
+
+        self.server = None
+        self.thread = None
+
+    def _make_post(self, post_id, md5, size):
+        rng = random.Random(post_id)
+        return {
+            "id": post_id,
+            "description": "Benchmark post {}".format(post_id),
+            "rating": rng.choice(["s", "q", "e"]),
+            "tags": {
+                "general": ["tag_{}".format(rng.randrange(500)) for i in range(rng.randrange(10, 60))],
+                "species": ["species_{}".format(rng.randrange(50)) for i in range(rng.randrange(1, 4))],
+                "character": [],
+                "copyright": [],
+                "artist": ["artist_{}".format(rng.randrange(100))],
+                "invalid": [],
+                "lore": [],
+                "meta": ["meta_{}".format(rng.randrange(10))]
+            },
+            "relationships": {
+                "parent_id": post_id - 1 if post_id % 10 == 0 else None,
+                "has_children": False,
+                "has_active_children": False,
+                "children": []
+            },
+            "file": {"width": 1, "height": 1, "ext": "png", "size": size, "md5": md5, "url": None},
+            "sample": {"has": False, "width": 1, "height": 1, "url": None},
+            "preview": {"width": 1, "height": 1, "url": None},
+            "flags": {"deleted": False},
+            "pools": [],
+            "sources": ["https://example.com/{}".format(post_id)]
+        }
+
+    @property
+    def base_url(self):
+        return "http://{}:{}/".format(*self.server.server_address)
+
+    def get_post(self, post_id):
+        post = json.loads(json.dumps(self.posts[post_id]))
+        post["file"]["url"] = "{}data/{}.png".format(self.base_url, post["file"]["md5"])
+        return post
+
+    def start(self, host="127.0.0.1", port=0):
+        mock = self
+
+        class Handler(MockHandler):
+            server_mock = mock
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_throttled(self, body, start):
+        # Trickle the body out at the configured bandwidth
+        mock = self.server_mock
+        chunk_size = 64 * 1024
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(chunk)
+            mock.count("file_bytes", len(chunk))
+            if mock.bandwidth != None:
+                delay = start + (i + len(chunk)) / mock.bandwidth - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def do_GET(self):
+        mock = self.server_mock
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path.startswith("/data/"):
+            self.get_file(url)
+            return
+
+        mock.count("api_requests")
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+        if mock.should_fail():
+            mock.count("errors")
+            self.send_body(503, b"{}", headers={"Retry-After": "0"})
+            return
+
+        match = re.match(r"^/posts/(\d+)\.json$", url.path)
+        if match != None:
+            post_id = int(match.group(1))
+            if post_id not in mock.posts:
+                self.send_body(404, b"{}")
+                return
+            self.send_body(200, json.dumps({"post": mock.get_post(post_id)}).encode())
+            return
+
+        if url.path == "/posts.json":
+            self.send_body(200, json.dumps({"posts": [mock.get_post(post_id) for post_id in self.search(query)]}).encode())
+            return
+
+        self.send_body(404, b"{}")
+
+    def search(self, query):
+        mock = self.server_mock
+        limit = int(query.get("limit", ["320"])[0])
+        page = query.get("page", [None])[0]
+        post_ids = sorted(mock.posts, reverse=True)
+
+        for tag in query.get("tags", [""])[0].split():
+            if tag.startswith("id:<"):
+                post_ids = [post_id for post_id in post_ids if post_id < int(tag[4:])]
+            elif tag.startswith("id:"):
+                wanted = set(int(post_id) for post_id in tag[3:].split(","))
+                post_ids = [post_id for post_id in post_ids if post_id in wanted]
+
+        if page != None and page.startswith("b"):
+            post_ids = [post_id for post_id in post_ids if post_id < int(page[1:])]
+        elif page != None and page.startswith("a"):
+            post_ids = sorted(post_id for post_id in post_ids if post_id > int(page[1:]))[:limit]
+            return sorted(post_ids, reverse=True)
+        elif page != None:
+            offset = (int(page) - 1) * limit
+            post_ids = post_ids[offset:]
+        return post_ids[:limit]
+
+    def get_file(self, url):
+        mock = self.server_mock
+        mock.count("file_requests")
+        start = time.monotonic()
+        if mock.file_latency > 0:
+            time.sleep(mock.file_latency)
+        if mock.should_fail():
+            mock.count("errors")
+            self.send_body(503, b"", content_type="text/plain", headers={"Retry-After": "0"})
+            return
+
+        md5 = url.path.rsplit("/", 1)[-1].split(".")[0]
+        data = mock.files.get(md5)
+        if data == None:
+            self.send_body(404, b"", content_type="text/plain")
+            return
+
+        # Range requests, so resumed downloads can be exercised too
+        offset = 0
+        status = 200
+        headers = {"Accept-Ranges": "bytes"}
+        range_header = self.headers.get("Range")
+        if range_header != None and mock.ranges:
+            offset = int(range_header.split("=")[1].split("-")[0])
+            if offset >= len(data):
+                self.send_body(416, b"", content_type="text/plain", headers={"Content-Range": "bytes */{}".format(len(data))})
+                return
+            status = 206
+            headers["Content-Range"] = "bytes {}-{}/{}".format(offset, len(data) - 1, len(data))
+
+        body = data[offset:]
+        self.send_response(status)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.send_throttled(body, start)
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Runs a local mock of the e621 API and file host")
+    parser.add_argument("--port", type=int, default=8621)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--file_size", type=int, default=64 * 1024, help="average file size in bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency for each API request")
+    parser.add_argument("--file_latency", type=float, default=0.0, help="seconds of latency before each file transfer")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second for each file transfer")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests that fail with a 503")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    args = parse_args()
+    mock = MockE621(posts=args.posts, file_size=args.file_size, latency=args.latency, file_latency=args.file_latency, bandwidth=args.bandwidth, error_rate=args.error_rate)
+    mock.start(port=args.port)
+    print("Mock e621 running at {}".format(mock.base_url), flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -2,9 +2,37 @@ from .core import (__default_user_agent__,
                    __default_name_pattern__,
                    __default_download_timeout__,
                    __default_memory_limit_ratio__,
+                   __default_pool_size__,
+                   __default_workers__,
                    __e621_base_url__,
                    __e621_endpoint_posts__,
                    __e621_posts_per_request_limit__,
+                   Client,
+                   get_default_client,
+                   set_default_client,
                    get_info_json,
                    get_info_json_multiple,
-                   download_image)
+                   get_info_json_batch,
+                   iter_posts,
+                   get_tags_from_json,
+                   get_tags_from_json_batch,
+                   flatten_tags,
+                   download_image,
+                   iter_download_images,
+                   download_images,
+                   iter_sync,
+                   sync,
+                   iter_download_shards,
+                   download_shards,
+                   MD5MismatchError)
+from .cache import PostCache
+from .throttle import RateLimiter, RetryPolicy
+from .journal import Journal
+from .metrics import Metrics, JsonLinesSink
+from .store import ContentStore
+from .shards import MetadataShards
+from .scheduler import Scheduler, ByteBudgetError
+from .sync import SyncState
+from .index import TagIndex
+from .memory import MemoryGovernor
+from .coordinator import Coordinator
@@ -0,0 +1,360 @@
+import asyncio
+import os
+import hashlib
+import functools
+import time
+import aiohttp
+
+from .throttle import RetryPolicy, __default_api_rate_limit__, __default_file_rate_limit__
+from .metrics import add_timing
+from .core import (__default_user_agent__,
+                   __default_name_pattern__,
+                   __default_download_timeout__,
+                   __default_memory_limit_ratio__,
+                   __default_chunk_size__,
+                   __e621_base_url__,
+                   build_post_url,
+                   build_posts_url,
+                   parse_auth,
+                   get_part_path,
+                   get_file_size,
+                   hash_file,
+                   finish_part_file,
+                   mark_verified,
+                   MD5MismatchError,
+                   get_rate_limiter,
+                   get_variant_info,
+                   get_item_id,
+                   get_item_json,
+                   give_up_download,
+                   run_hooks,
+                   index_image,
+                   make_results,
+                   make_error_results,
+                   prepare_download,
+                   tag_image,
+                   print_if_true)
+
+__default_concurrency__ = 256
+__default_write_size__ = 1024 * 1024 # 1 MiB, written to disk in one go from a thread
+
+def write_and_close(f, data):
+    with f:
+        f.write(data)
+
+class AsyncClient:
+    def __init__(self, base_url=__e621_base_url__, auth=None, user_agent=__default_user_agent__, concurrency=__default_concurrency__, executor=None, cache=None, api_rate_limit=__default_api_rate_limit__, file_rate_limit=__default_file_rate_limit__, retry_policy=None, hooks=None):
+        if type(concurrency) != int or concurrency < 1:
+            raise ValueError("The 'concurrency' parameter must be an integer greater than 0")
+        
+        self.base_url = base_url
+        self.auth = auth
+        self.user_agent = user_agent
+        self.concurrency = concurrency
+        self.executor = executor
+        self.cache = cache
+        self.api_limiter = get_rate_limiter(api_rate_limit)
+        self.file_limiter = get_rate_limiter(file_rate_limit)
+        if retry_policy == None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        self.hooks = list(hooks or [])
+        self.session = None
+        self.semaphore = None
+    
+    async def __aenter__(self):
+        await self.open()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+    
+    async def open(self):
+        if self.session == None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self.session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": self.user_agent})
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+    
+    async def close(self):
+        if self.session != None:
+            await self.session.close()
+            self.session = None
+    
+    async def _run_blocking(self, function, *args, **kwargs):
+        # File and SQLite work goes to the loop's own thread pool, since self.executor may be a process pool for embedding
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
+    
+    def _request_args(self, auth=None, user_agent=None):
+        if auth == None:
+            auth = self.auth
+        
+        kwargs = dict()
+        auth = parse_auth(auth)
+        if auth != None:
+            kwargs["auth"] = aiohttp.BasicAuth(auth.username, auth.password)
+        if user_agent != None and user_agent != self.user_agent:
+            kwargs["headers"] = {"User-Agent": user_agent}
+        return kwargs
+    
+    async def _get(self, url, kind="api", results=None, **kwargs):
+        if kind == "api":
+            limiter = self.api_limiter
+        else:
+            limiter = self.file_limiter
+        
+        # Waiting for the limiter, waiting for the response and backing off are timed apart, so one doesn't hide in another
+        attempt = 0
+        while True:
+            attempt += 1
+            if limiter != None:
+                delay = limiter.reserve()
+                add_timing(results, "rate_limit", delay)
+                await asyncio.sleep(delay)
+            
+            # Broken and throttled file transfers are retried by download_image, which can resume them
+            start = time.perf_counter()
+            try:
+                r = await self.session.get(url, **kwargs)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                add_timing(results, "first_byte", time.perf_counter() - start)
+                if kind != "api" or not self.retry_policy.can_retry(attempt):
+                    raise
+                delay = self.retry_policy.get_delay(attempt)
+                add_timing(results, "retry_wait", delay)
+                await asyncio.sleep(delay)
+                continue
+            add_timing(results, "first_byte", time.perf_counter() - start)
+            
+            if kind != "api" or not self.retry_policy.should_retry_status(r.status, attempt):
+                return r
+            
+            r.release()
+            delay = self.retry_policy.back_off(attempt, limiter=limiter, status_code=r.status, retry_after=r.headers.get("Retry-After"))
+            add_timing(results, "retry_wait", delay)
+            await asyncio.sleep(delay)
+    
+    async def _get_json(self, url, auth=None, user_agent=None):
+        await self.open()
+        async with self.semaphore:
+            async with await self._get(url, **self._request_args(auth=auth, user_agent=user_agent)) as r:
+                if r.status in self.retry_policy.retry_statuses:
+                    r.raise_for_status()
+                if r.status != 200:
+                    return None
+                return await r.json()
+    
+    async def get_info_json(self, post_id, auth=None, user_agent=None):
+        url = build_post_url(post_id, base_url=self.base_url)
+        
+        if self.cache != None:
+            post = await self._run_blocking(self.cache.get, post_id)
+            if post != None:
+                return post
+        
+        data = await self._get_json(url, auth=auth, user_agent=user_agent)
+        if data == None:
+            return None
+        
+        if self.cache != None:
+            await self._run_blocking(self.cache.put, data["post"])
+        return data["post"]
+    
+    async def get_info_json_multiple(self, page=None, page_modifier=None, limit=None, include_deleted=False, tags=None, auth=None, user_agent=None):
+        url = build_posts_url(page=page, page_modifier=page_modifier, limit=limit, include_deleted=include_deleted, tags=tags, base_url=self.base_url)
+        
+        data = await self._get_json(url, auth=auth, user_agent=user_agent)
+        if data == None:
+            return None
+        
+        if self.cache != None:
+            await self._run_blocking(self.cache.put_many, data["posts"])
+        return data["posts"]
+    
+    async def download_file(self, url, filename, user_agent=None, timeout=None, chunk_size=__default_chunk_size__, md5=None, results=None):
+        await self.open()
+        kwargs = self._request_args(user_agent=user_agent)
+        if timeout != None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+        
+        # Stream into a partial file, resuming it if an earlier attempt was cut off
+        part_path = get_part_path(filename)
+        part_size = get_file_size(part_path)
+        if part_size > 0:
+            kwargs.setdefault("headers", dict())["Range"] = "bytes={}-".format(part_size)
+        
+        async with self.semaphore:
+            async with await self._get(url, kind="file", results=results, **kwargs) as r:
+                # The partial file is already the whole file
+                if r.status == 416:
+                    hasher = await self._run_blocking(hash_file, part_path, chunk_size=chunk_size)
+                    finish_part_file(part_path, filename, md5=md5, hasher=hasher)
+                    return
+                r.raise_for_status()
+                
+                # The server ignored the range request, so start over
+                if r.status != 206:
+                    part_size = 0
+                
+                expected_size = r.content_length
+                if expected_size != None:
+                    expected_size += part_size
+                
+                # Hash the bytes as they arrive, starting with any resumed part
+                if md5 != None and part_size > 0:
+                    hasher = await self._run_blocking(hash_file, part_path, chunk_size=chunk_size)
+                else:
+                    hasher = hashlib.md5()
+                
+                # Bytes from a broken transfer still count, since they were received
+                transfer_start = time.perf_counter()
+                received_size = 0
+                # Chunks are gathered into bigger writes, so the loop isn't handing every chunk to a thread
+                f = await self._run_blocking(open, part_path, "ab" if part_size > 0 else "wb")
+                buffer = bytearray()
+                try:
+                    async for chunk in r.content.iter_chunked(chunk_size):
+                        buffer += chunk
+                        received_size += len(chunk)
+                        if md5 != None:
+                            hasher.update(chunk)
+                        if len(buffer) >= __default_write_size__:
+                            await self._run_blocking(f.write, bytes(buffer))
+                            buffer = bytearray()
+                finally:
+                    await self._run_blocking(write_and_close, f, bytes(buffer))
+                    written_size = get_file_size(part_path)
+                    add_timing(results, "transfer", time.perf_counter() - transfer_start, size=received_size)
+        
+        if expected_size != None and written_size < expected_size:
+            raise aiohttp.ClientPayloadError("Download ended early ({} of {} bytes)".format(written_size, expected_size))
+        
+        finish_part_file(part_path, filename, md5=md5, hasher=hasher)
+    
+    async def download_image(self, post_id, output_folder=".", name_pattern=__default_name_pattern__, add_tags=True, save_json=False, use_messages=False, use_warnings=True, custom_json=None, auth=None, download_timeout=__default_download_timeout__, user_agent=None, memory_limit_ratio=__default_memory_limit_ratio__, chunk_size=__default_chunk_size__, verify_md5=True, skip_existing=False, metadata_sink=None, variant="file", tag_index=None, memory_governor=None):
+        results = await self._download_image(post_id, output_folder=output_folder, name_pattern=name_pattern, add_tags=add_tags, save_json=save_json, use_messages=use_messages, use_warnings=use_warnings, custom_json=custom_json, auth=auth, download_timeout=download_timeout, user_agent=user_agent, memory_limit_ratio=memory_limit_ratio, chunk_size=chunk_size, verify_md5=verify_md5, skip_existing=skip_existing, metadata_sink=metadata_sink, variant=variant, tag_index=tag_index, memory_governor=memory_governor)
+        run_hooks(self.hooks, results)
+        return results
+    
+    async def _download_image(self, post_id, output_folder=".", name_pattern=__default_name_pattern__, add_tags=True, save_json=False, use_messages=False, use_warnings=True, custom_json=None, auth=None, download_timeout=__default_download_timeout__, user_agent=None, memory_limit_ratio=__default_memory_limit_ratio__, chunk_size=__default_chunk_size__, verify_md5=True, skip_existing=False, metadata_sink=None, variant="file", tag_index=None, memory_governor=None):
+        # Prepare results object
+        results = make_results(post_id)
+        
+        # Get information from e621 API
+        if custom_json != None:
+            image_info = custom_json
+        else:
+            print_if_true("    Getting info for e621 post...".format(post_id), use_messages)
+            start = time.perf_counter()
+            image_info = await self.get_info_json(post_id, user_agent=user_agent, auth=auth)
+            add_timing(results, "fetch_info", time.perf_counter() - start)
+        
+        image_path = await self._run_blocking(prepare_download, post_id, image_info, results, output_folder=output_folder, name_pattern=name_pattern, save_json=save_json, metadata_sink=metadata_sink, use_messages=use_messages, skip_existing=skip_existing, chunk_size=chunk_size, variant=variant)
+        if image_path == None:
+            await self._run_blocking(index_image, tag_index, post_id, image_info, results)
+            return results
+        
+        # Only the original file has an MD5 to check against
+        variant_info = get_variant_info(image_info, variant)
+        md5 = None
+        if verify_md5:
+            md5 = variant_info["md5"]
+        
+        # Download image
+        print_if_true("    Downloading image...", use_messages)
+        attempt = 0
+        while not results["saved_image"]:
+            attempt += 1
+            status_code = None
+            retry_after = None
+            try:
+                await self.download_file(variant_info["url"], image_path, user_agent=user_agent, timeout=download_timeout, chunk_size=chunk_size, md5=md5, results=results)
+                results["saved_image"] = True
+                results["path_image"] = image_path
+                await self._run_blocking(index_image, tag_index, post_id, image_info, results)
+                continue
+            except asyncio.TimeoutError as e:
+                error = e
+                message = "Download timed out"
+            except aiohttp.ClientConnectionError as e:
+                error = e
+                message = "Download timed out"
+            except aiohttp.ClientPayloadError as e:
+                error = e
+                message = "Download was cut off"
+            except MD5MismatchError as e:
+                error = e
+                message = "Downloaded file was corrupt"
+            except aiohttp.ClientResponseError as e:
+                error = e
+                message = "Server error"
+                status_code = e.status
+                if e.headers != None:
+                    retry_after = e.headers.get("Retry-After")
+            
+            failed = give_up_download(self.retry_policy, attempt, message, error, image_path, status_code=status_code, use_messages=use_messages)
+            if failed != None:
+                results["error"] = failed
+                return results
+            delay = self.retry_policy.back_off(attempt, limiter=self.file_limiter, status_code=status_code, retry_after=retry_after)
+            add_timing(results, "retry_wait", delay)
+            await asyncio.sleep(delay)
+        
+        # Embedding is blocking, so it runs in an executor to keep the loop free
+        if add_tags:
+            loop = asyncio.get_running_loop()
+            embed = functools.partial(tag_image, image_path, post_id, image_info, base_url=self.base_url, use_messages=use_messages, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio, verify_md5=False, variant=variant, memory_governor=memory_governor)
+            start = time.perf_counter()
+            results["saved_tags"] = await loop.run_in_executor(self.executor, embed)
+            add_timing(results, "embed", time.perf_counter() - start)
+        
+        if md5 != None:
+            await self._run_blocking(mark_verified, image_path, md5)
+        
+        print_if_true("    Done downloading! Location: {}".format(image_path), use_messages)
+        return results
+    
+    async def _download_image_safe(self, item, **kwargs):
+        # A single failing post must not take down the rest of the batch
+        post_id = get_item_id(item)
+        try:
+            results = await self._download_image(post_id, custom_json=get_item_json(item), **kwargs)
+        except Exception as e:
+            results = make_error_results(post_id, e)
+        run_hooks(self.hooks, results)
+        return results
+    
+    async def download_images(self, items, **kwargs):
+        # Only a window of posts has a task at a time, so a long stream of posts isn't all scheduled up front
+        window = self.concurrency * 2
+        results = list()
+        pending = dict()
+        for item in items:
+            if len(pending) >= window:
+                done, not_done = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results[pending.pop(task)] = task.result()
+            pending[asyncio.ensure_future(self._download_image_safe(item, **kwargs))] = len(results)
+            results.append(None)
+        
+        if len(pending) > 0:
+            await asyncio.wait(pending)
+            for task, i in pending.items():
+                results[i] = task.result()
+        return results
+
+async def get_info_json(post_id, auth=None, user_agent=__default_user_agent__):
+    async with AsyncClient(auth=auth, user_agent=user_agent) as client:
+        return await client.get_info_json(post_id)
+
+async def get_info_json_multiple(page=None, page_modifier=None, limit=None, include_deleted=False, tags=None, auth=None, user_agent=__default_user_agent__):
+    async with AsyncClient(auth=auth, user_agent=user_agent) as client:
+        return await client.get_info_json_multiple(page=page, page_modifier=page_modifier, limit=limit, include_deleted=include_deleted, tags=tags)
+
+async def download_image(post_id, user_agent=__default_user_agent__, auth=None, **kwargs):
+    async with AsyncClient(auth=auth, user_agent=user_agent) as client:
+        return await client.download_image(post_id, **kwargs)
+
+async def download_images(items, concurrency=__default_concurrency__, user_agent=__default_user_agent__, auth=None, **kwargs):
+    async with AsyncClient(auth=auth, user_agent=user_agent, concurrency=concurrency) as client:
+        return await client.download_images(items, **kwargs)
@@ -0,0 +1,135 @@
+import collections
+import json
+import threading
+import time
+
+from .lazy import lazy_import
+
+sqlite3 = lazy_import("sqlite3")
+
+__default_cache_ttl__ = 60 * 60 * 24 * 7 # 1 week
+__default_cache_max_entries__ = 1000000
+__default_cache_memory_entries__ = 10000
+
+class PostCache:
+    def __init__(self, path, ttl=__default_cache_ttl__, max_entries=__default_cache_max_entries__, memory_entries=__default_cache_memory_entries__):
+        if ttl != None and (type(ttl) not in [int, float] or ttl < 0):
+            raise ValueError("The 'ttl' parameter must be a positive number of seconds, or None to never expire")
+        if max_entries != None and (type(max_entries) != int or max_entries < 1):
+            raise ValueError("The 'max_entries' parameter must be an integer greater than 0, or None for no limit")
+        if type(memory_entries) != int or memory_entries < 0:
+            raise ValueError("The 'memory_entries' parameter must be a positive integer")
+        
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        
+        # Hot entries are kept in memory in front of the database
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS posts (id INTEGER PRIMARY KEY, fetched REAL NOT NULL, data TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS posts_fetched ON posts (fetched)")
+        self.db.commit()
+        self.count = self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+    
+    def _is_fresh(self, fetched):
+        return self.ttl == None or time.time() - fetched <= self.ttl
+    
+    def _remember(self, post_id, fetched, post):
+        if self.memory_entries == 0:
+            return
+        self.memory[post_id] = (fetched, post)
+        self.memory.move_to_end(post_id)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+    
+    def get(self, post_id):
+        return self.get_many([post_id]).get(post_id)
+    
+    def get_many(self, post_ids):
+        found = dict()
+        with self.lock:
+            missing = list()
+            for post_id in post_ids:
+                entry = self.memory.get(post_id)
+                if entry != None and self._is_fresh(entry[0]):
+                    self.memory.move_to_end(post_id)
+                    found[post_id] = entry[1]
+                else:
+                    missing.append(post_id)
+            
+            # SQLite limits the number of bound parameters per statement
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = self.db.execute("SELECT id, fetched, data FROM posts WHERE id IN ({})".format(",".join("?" * len(chunk))), chunk)
+                for post_id, fetched, data in rows:
+                    if self._is_fresh(fetched):
+                        post = json.loads(data)
+                        self._remember(post_id, fetched, post)
+                        found[post_id] = post
+        
+        return found
+    
+    def put(self, post):
+        self.put_many([post])
+    
+    def put_many(self, posts):
+        fetched = time.time()
+        rows = [(post["id"], fetched, json.dumps(post, separators=(",", ":"))) for post in posts]
+        
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO posts (id, fetched, data) VALUES (?, ?, ?)", rows)
+            self.count += len(rows)
+            for post in posts:
+                self._remember(post["id"], fetched, post)
+            self._evict()
+            self.db.commit()
+    
+    def _evict(self):
+        if self.max_entries == None:
+            return
+        
+        # Replaced rows make the running count an overestimate, so only recount when it looks full
+        if self.count <= self.max_entries:
+            return
+        self.count = self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        
+        # The oldest fetches go first, which are also the first to go stale
+        extra = self.count - self.max_entries
+        if extra > 0:
+            self.db.execute("DELETE FROM posts WHERE id IN (SELECT id FROM posts ORDER BY fetched LIMIT ?)", (extra,))
+            self.count -= extra
+    
+    def delete(self, post_id):
+        with self.lock:
+            self.memory.pop(post_id, None)
+            self.count -= self.db.execute("DELETE FROM posts WHERE id = ?", (post_id,)).rowcount
+            self.db.commit()
+    
+    def clear(self, expired_only=False):
+        with self.lock:
+            if expired_only and self.ttl != None:
+                self.db.execute("DELETE FROM posts WHERE fetched < ?", (time.time() - self.ttl,))
+            else:
+                self.db.execute("DELETE FROM posts")
+            self.count = self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+            self.memory.clear()
+            self.db.commit()
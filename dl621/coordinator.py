@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+
+from .lazy import lazy_import
+from .sync import get_sync_query
+
+sqlite3 = lazy_import("sqlite3")
+socket = lazy_import("socket")
+uuid = lazy_import("uuid")
+
+__default_shard_size__ = 50000 # post IDs
+__default_lease_time__ = 300 # 5 minutes
+__default_shard_attempts__ = 3
+__default_coordinator_timeout__ = 60 # 60 seconds to wait for another node's lock
+
+def get_worker_id():
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+def get_shard_tags(tags, high):
+    # The upper bound goes in the query, the lower one is the after-ID cursor
+    if tags == None or tags.strip() == "":
+        return "id:<{}".format(high)
+    return "{} id:<{}".format(tags, high)
+
+class Coordinator:
+    def __init__(self, path, lease_time=__default_lease_time__, max_attempts=__default_shard_attempts__, timeout=__default_coordinator_timeout__):
+        if type(lease_time) not in [int, float] or lease_time <= 0:
+            raise ValueError("The 'lease_time' parameter must be a number of seconds greater than 0")
+        if type(max_attempts) != int or max_attempts < 1:
+            raise ValueError("The 'max_attempts' parameter must be an integer greater than 0")
+        
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        
+        # Nodes share the file over a network filesystem, where WAL doesn't work, so this relies on SQLite's own file locks
+        self.db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shards (query TEXT NOT NULL, shard INTEGER NOT NULL, low INTEGER NOT NULL, high INTEGER NOT NULL, cursor INTEGER NOT NULL, state TEXT NOT NULL, worker TEXT, lease_until REAL, attempts INTEGER NOT NULL, failed INTEGER NOT NULL, PRIMARY KEY (query, shard))")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+    
+    def _transaction(self, function, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, so two nodes can never claim the same shard
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+    
+    def plan(self, tags, max_id, shard_size=__default_shard_size__):
+        if type(shard_size) != int or shard_size < 1:
+            raise ValueError("The 'shard_size' parameter must be an integer greater than 0")
+        return self._transaction(self._plan, get_sync_query(tags or ""), max_id, shard_size)
+    
+    def _plan(self, query, max_id, shard_size):
+        # Only adds shards past the ones already planned, so later runs pick up new posts
+        row = self.db.execute("SELECT shard, low, high FROM shards WHERE query = ? ORDER BY shard DESC LIMIT 1", (query,)).fetchone()
+        if row == None:
+            shard, low = 0, 1
+        else:
+            shard, low, high = row
+            
+            # The newest shard only reaches the newest post it was planned with, so it grows (and opens again if it was done) as posts are added
+            if high < low + shard_size and max_id >= high:
+                self.db.execute("UPDATE shards SET high = ?, attempts = CASE WHEN state = 'done' THEN 0 ELSE attempts END, state = CASE WHEN state = 'done' THEN 'pending' ELSE state END WHERE query = ? AND shard = ?", (min(low + shard_size, max_id + 1), query, shard))
+                high = min(low + shard_size, max_id + 1)
+            shard += 1
+            low = high
+        
+        rows = list()
+        while low <= max_id:
+            high = min(low + shard_size, max_id + 1)
+            rows.append((query, shard, low, high, low - 1, "pending", 0, 0))
+            shard += 1
+            low = high
+        self.db.executemany("INSERT INTO shards (query, shard, low, high, cursor, state, attempts, failed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+    
+    def claim(self, tags, worker_id):
+        return self._transaction(self._claim, get_sync_query(tags or ""), worker_id)
+    
+    def _claim(self, query, worker_id):
+        # Shards whose lease ran out belonged to a worker that died, so they go back in the queue
+        now = time.time()
+        row = self.db.execute("SELECT shard, low, high, cursor, attempts FROM shards WHERE query = ? AND (state = 'pending' OR (state = 'leased' AND lease_until < ?)) ORDER BY attempts, shard LIMIT 1", (query, now)).fetchone()
+        if row == None:
+            return None
+        shard, low, high, cursor, attempts = row
+        self.db.execute("UPDATE shards SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE query = ? AND shard = ?", (worker_id, now + self.lease_time, query, shard))
+        return {"query": query, "shard": shard, "low": low, "high": high, "cursor": cursor, "attempts": attempts + 1}
+    
+    def _update(self, shard, worker_id, sql, args):
+        cursor = self.db.execute("UPDATE shards SET {} WHERE query = ? AND shard = ? AND state = 'leased' AND worker = ?".format(sql), tuple(args) + (shard["query"], shard["shard"], worker_id))
+        return cursor.rowcount == 1
+    
+    def renew(self, shard, worker_id, cursor=None):
+        # False means the lease was lost to another worker, and this one has to stop
+        if cursor == None:
+            cursor = shard["cursor"]
+        return self._transaction(self._update, shard, worker_id, "lease_until = ?, cursor = MAX(cursor, ?)", (time.time() + self.lease_time, cursor))
+    
+    def complete(self, shard, worker_id, cursor=None, failed=0):
+        # A shard that grew while it was leased goes back in the queue, for the posts past what this worker was given
+        if cursor == None:
+            cursor = shard["high"] - 1
+        return self._transaction(self._update, shard, worker_id, "state = CASE WHEN high > ? THEN 'pending' ELSE 'done' END, attempts = CASE WHEN high > ? THEN 0 ELSE attempts END, worker = NULL, lease_until = NULL, cursor = MAX(cursor, ?), failed = ?", (shard["high"], shard["high"], cursor, failed))
+    
+    def release(self, shard, worker_id, cursor=None):
+        # Hand the shard back, to be picked up again from the cursor
+        if cursor == None:
+            cursor = shard["cursor"]
+        return self._transaction(self._update, shard, worker_id, "state = 'pending', worker = NULL, lease_until = NULL, cursor = MAX(cursor, ?)", (cursor,))
+    
+    def lease(self, shard, worker_id):
+        return Lease(self, shard, worker_id)
+    
+    def get_status(self, tags):
+        with self.lock:
+            rows = self.db.execute("SELECT state, COUNT(*), SUM(failed) FROM shards WHERE query = ? GROUP BY state", (get_sync_query(tags or ""),)).fetchall()
+        status = {"pending": 0, "leased": 0, "done": 0, "failed_posts": 0}
+        for state, count, failed in rows:
+            status[state] = count
+            status["failed_posts"] += failed or 0
+        return status
+
+class Lease:
+    def __init__(self, coordinator, shard, worker_id):
+        self.coordinator = coordinator
+        self.shard = shard
+        self.worker_id = worker_id
+        self.cursor = shard["cursor"]
+        self.lost = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._keep, daemon=True)
+    
+    def __enter__(self):
+        self.thread.start()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+    
+    def _keep(self):
+        # Renew well before the lease runs out, saving the cursor so a dead worker's shard resumes where it stopped
+        while not self.stopped.wait(self.coordinator.lease_time / 3):
+            try:
+                renewed = self.coordinator.renew(self.shard, self.worker_id, cursor=self.cursor)
+            except sqlite3.OperationalError:
+                # Another node held the lock too long, there is still time to try again
+                continue
+            if not renewed:
+                self.lost.set()
+                return
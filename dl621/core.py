@@ -1,47 +1,244 @@
-import argparse
 import sys
 import warnings
 import json
-import requests
-import socket
-import urllib.request
 import os
-import imgtag
+import threading
+import collections
+import time
+
+from .lazy import lazy_import
+from .cache import PostCache, __default_cache_ttl__
+from .coordinator import Coordinator, get_worker_id, get_shard_tags, __default_shard_size__, __default_lease_time__
+from .index import TagIndex
+from .journal import Journal, is_complete
+from .memory import MemoryGovernor, estimate_embed_memory, set_memory_limit, get_memory_limit, restore_memory_limit, __default_memory_limit_ratio__, __governed_memory_limit_ratio__
+from .metrics import Metrics, JsonLinesSink, add_timing, timed_call
+from .scheduler import Scheduler, ByteBudgetError, __default_large_file_size__
+from .shards import MetadataShards
+from .store import ContentStore
+from .sync import SyncState
+from .throttle import RateLimiter, RetryPolicy, __default_api_rate_limit__, __default_file_rate_limit__, __default_max_attempts__
+
+# These are slow to import, so they are only loaded once they are used (like imgtag, only when tags are embedded)
+argparse = lazy_import("argparse")
+concurrent = lazy_import("concurrent.futures")
+hashlib = lazy_import("hashlib")
+requests = lazy_import("requests")
+imgtag = lazy_import("imgtag")
 
 __default_user_agent__ = "dl621/1.0 (by nimaid on e621)"
 __default_name_pattern__ = "dl621_{i}_{m}"
 __default_download_timeout__ = 5 # 5 seconds
-__default_memory_limit_ratio__= imgtag.__DEFAULT_MEMORY_LIMIT_RATIO__
 __e621_base_url__ = "https://e621.net/"
 __e621_endpoint_posts__ = "posts"
 __e621_posts_per_request_limit__ = 320
+__default_pool_size__ = 16
+__default_workers__ = 4
+__default_chunk_size__ = 1024 * 64 # 64 KiB
+__verified_xattr__ = "user.dl621.md5"
+__verified_manifest__ = ".dl621_verified" # The same stamps, for filesystems without extended attributes
+__variants__ = ("file", "sample", "preview")
 
-def get_info_json(post_id, auth=None, user_agent=__default_user_agent__):
-    if type(post_id) != int:
-        raise TypeError("'post_id' must be an integer.")
+def make_results(post_id=None):
+    return {
+        "post_id": post_id,
+        "post_exists": True,
+        "post_deleted": False,
+        "post_missing_url": False,
+        "saved_image": False,
+        "skipped_image": False,
+        "saved_tags": False,
+        "saved_json": False,
+        "path_image": "",
+        "path_json": "",
+        "variant": "",
+        "error": "",
+        "timings": {},
+        "bytes": {}
+    }
+
+def parse_auth(auth):
+    if auth == None:
+        return None
     
-    url = "{}{}/{}.json".format(__e621_base_url__, __e621_endpoint_posts__, post_id)
+    auth = auth.split(":")
+    if len(auth) != 2:
+        raise ValueError("'auth' argument must be a string in the form of 'username:api_key'")
     
-    headers = {"User-Agent": user_agent}
+    return requests.auth.HTTPBasicAuth(auth[0], auth[1])
+
+def get_part_path(filename):
+    return filename + os.path.extsep + "part"
+
+def remove_part_file(filename):
+    try:
+        os.remove(get_part_path(filename))
+    except FileNotFoundError:
+        pass
+
+def get_file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+class MD5MismatchError(IOError):
+    pass
+
+def hash_file(filename, chunk_size=__default_chunk_size__):
+    hasher = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher
+
+def finish_part_file(part_path, filename, md5=None, hasher=None):
+    # A corrupt partial file can't be resumed, so it is thrown away
+    if md5 != None and hasher.hexdigest() != md5.lower():
+        os.remove(part_path)
+        raise MD5MismatchError("MD5 mismatch for {} (expected {}, got {})".format(filename, md5, hasher.hexdigest()))
     
-    if auth != None:
-        auth = auth.split(":")
-        if len(auth) != 2:
-            raise ValueError("'auth' argument must be a string in the form of 'username:api_key'")
+    os.replace(part_path, filename)
+
+def get_verified_stamp(filename, md5):
+    stat = os.stat(filename)
+    return "{} {} {}".format(md5.lower(), stat.st_size, stat.st_mtime_ns).encode()
+
+def get_manifest_path(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), __verified_manifest__)
+
+_manifests = dict()
+_manifests_lock = threading.Lock()
+
+def read_manifest(manifest_path):
+    # Manifests are only ever appended to, so each read only parses the lines added since the last one
+    with _manifests_lock:
+        offset, stamps = _manifests.get(manifest_path, (0, dict()))
+        try:
+            with open(manifest_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < offset:
+                    offset, stamps = 0, dict()
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return stamps
         
-        a = requests.auth.HTTPBasicAuth(auth[0], auth[1])
-        r = requests.get(url, headers=headers, auth=a)
-    else:
-        r = requests.get(url, headers=headers)
+        # A line that is still being written is left for next time
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            name, _, stamp = line.rpartition(b"\t")
+            stamps[name.decode(errors="replace")] = stamp
+        _manifests[manifest_path] = (offset + end, stamps)
+        return stamps
+
+def mark_verified(filename, md5):
+    # Remember that the file came from this MD5, since embedding tags changes its hash
+    stamp = get_verified_stamp(filename, md5)
+    try:
+        os.setxattr(filename, __verified_xattr__, stamp)
+        return
+    except (AttributeError, OSError):
+        pass
     
-    if r.status_code != 200:
-        return None
+    # Without extended attributes, the stamp goes in a manifest in the same folder, one appended line per file
+    name = os.path.basename(filename)
+    if "\n" in name:
+        return
+    try:
+        with open(get_manifest_path(filename), "ab") as f:
+            f.write(name.encode() + b"\t" + stamp + b"\n")
+    except OSError:
+        pass
+
+def is_verified(filename, md5, chunk_size=__default_chunk_size__):
+    if not os.path.isfile(filename):
+        return False
+    
+    stamp = get_verified_stamp(filename, md5)
+    try:
+        if os.getxattr(filename, __verified_xattr__) == stamp:
+            return True
+    except (AttributeError, OSError):
+        pass
+    if read_manifest(get_manifest_path(filename)).get(os.path.basename(filename)) == stamp:
+        return True
     
-    return r.json()["post"]
+    return hash_file(filename, chunk_size=chunk_size).hexdigest() == md5.lower()
 
-def get_info_json_multiple(page=None, page_modifier=None, limit=None, include_deleted=False, tags=None, auth=None, user_agent=__default_user_agent__):
+def get_item_id(item):
+    if isinstance(item, dict):
+        return item.get("id")
+    return item
+
+def get_item_json(item):
+    # Bulk downloads take post IDs or post JSON, and JSON doesn't have to be looked up again
+    if isinstance(item, dict):
+        return item
+    return None
+
+def format_error(error):
+    return "{}: {}".format(type(error).__name__, error)
+
+def make_error_results(post_id, error):
+    results = make_results(post_id)
+    results["error"] = format_error(error)
+    return results
+
+def run_hooks(hooks, results):
+    # A broken metrics sink must not stop the downloads
+    for hook in hooks:
+        try:
+            hook(results)
+        except Exception as e:
+            warnings.warn("Hook {} failed: {}".format(hook, format_error(e)))
+
+def give_up_download(retry_policy, attempt, message, error, filename, status_code=None, use_messages=False):
+    # Returns the error to give up with, or None when the download should be tried again
+    # A missing or forbidden file won't come back by asking again, and neither will its partial file
+    if status_code != None and status_code < 500 and status_code not in retry_policy.retry_statuses:
+        remove_part_file(filename)
+        print_if_true("        Download failed (HTTP {}), skipping.".format(status_code), use_messages)
+        return format_error(error)
+    
+    if not retry_policy.can_retry(attempt):
+        print_if_true("        {}, giving up after {} attempts.".format(message, attempt), use_messages)
+        return format_error(error)
+    print_if_true("        {}, retrying...".format(message), use_messages)
+    return None
+
+def get_variant_info(image_info, variant="file"):
+    if variant not in __variants__:
+        raise ValueError("The 'variant' parameter must be 'file', 'sample' or 'preview'")
+    
+    # Posts without a sample or preview fall back to the original file, e621 still gives a sample URL (of the original) when "has" is false
+    file_info = image_info["file"]
+    variant_src = image_info.get(variant) or {}
+    if variant != "file" and (variant_src.get("url") == None or not variant_src.get("has", True)):
+        variant = "file"
+    if variant == "file":
+        return {"variant": "file", "url": file_info["url"], "ext": file_info["ext"], "md5": file_info["md5"], "size": file_info["size"], "key": file_info["md5"]}
+    
+    # Samples and previews have no MD5 or size of their own, and usually a different extension
+    url = image_info[variant]["url"]
+    ext = os.path.splitext(url.split("?")[0])[1][1:]
+    if ext == "":
+        ext = file_info["ext"]
+    return {"variant": variant, "url": url, "ext": ext, "md5": None, "size": None, "key": "{}_{}".format(file_info["md5"], variant)}
+
+def get_rate_limiter(rate_limit):
+    if rate_limit == None or isinstance(rate_limit, RateLimiter):
+        return rate_limit
+    return RateLimiter(rate_limit)
+
+def build_post_url(post_id, base_url=__e621_base_url__):
+    if type(post_id) != int:
+        raise TypeError("'post_id' must be an integer.")
+    
+    return "{}{}/{}.json".format(base_url, __e621_endpoint_posts__, post_id)
+
+def build_posts_url(page=None, page_modifier=None, limit=None, include_deleted=False, tags=None, base_url=__e621_base_url__):
     # Build URL
-    url = "{}{}.json".format(__e621_base_url__, __e621_endpoint_posts__)
+    url = "{}{}.json".format(base_url, __e621_endpoint_posts__)
     
     if limit != None:
         if type(limit) != int:
@@ -65,186 +262,986 @@ def get_info_json_multiple(page=None, page_modifier=None, limit=None, include_de
         raise TypeError("The 'page' parameter must be an integer (use 'page_modifier' for [b]efore and [a]fter)")
     
     if include_deleted:
-        tags += "+status:any"
+        if tags == None:
+            tags = "status:any"
+        else:
+            tags += "+status:any"
     
     if tags != None:
         if type(tags) != str:
             raise ValueError("The 'tags' parameter must be a string")
         url += "&tags={}".format(tags)
     
-    # Get the data
-    headers = {"User-Agent": user_agent}
+    return url
+
+class Client:
+    def __init__(self, base_url=__e621_base_url__, auth=None, user_agent=__default_user_agent__, pool_size=__default_pool_size__, cache=None, api_rate_limit=__default_api_rate_limit__, file_rate_limit=__default_file_rate_limit__, retry_policy=None, hooks=None):
+        if type(pool_size) != int or pool_size < 1:
+            raise ValueError("The 'pool_size' parameter must be an integer greater than 0")
+        
+        self.base_url = base_url
+        self.auth = auth
+        self.user_agent = user_agent
+        self.pool_size = pool_size
+        self.cache = cache
+        
+        # Separate budgets for the API and the file host, a RateLimiter can be shared between clients
+        self.api_limiter = get_rate_limiter(api_rate_limit)
+        self.file_limiter = get_rate_limiter(file_rate_limit)
+        if retry_policy == None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        
+        # Called with the results of every finished post, like a Metrics or JsonLinesSink
+        self.hooks = list(hooks or [])
+        
+        # One keep-alive session shared by every API and download call
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
-    if auth != None:
-        auth = auth.split(":")
-        if len(auth) != 2:
-            raise ValueError("'auth' argument must be a string in the form of 'username:api_key'")
+    def close(self):
+        self.session.close()
+        if self.cache != None:
+            self.cache.close()
+    
+    def get(self, url, auth=None, user_agent=None, headers=None, kind="api", results=None, **kwargs):
+        if auth == None:
+            auth = self.auth
+        auth = parse_auth(auth)
         
-        a = requests.auth.HTTPBasicAuth(auth[0], auth[1])
-        r = requests.get(url, headers=headers, auth=a)
-    else:
-        r = requests.get(url, headers=headers)
+        headers = dict(headers or {})
+        if user_agent != None and user_agent != self.user_agent:
+            headers["User-Agent"] = user_agent
+        
+        if kind == "api":
+            limiter = self.api_limiter
+        else:
+            limiter = self.file_limiter
+        
+        # Waiting for the limiter, waiting for the response and backing off are timed apart, so one doesn't hide in another
+        attempt = 0
+        while True:
+            attempt += 1
+            if limiter != None:
+                delay = limiter.reserve()
+                add_timing(results, "rate_limit", delay)
+                if delay > 0:
+                    time.sleep(delay)
+            
+            # Broken and throttled file transfers are retried by download_image, which can resume them
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, headers=headers, auth=auth, **kwargs)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                add_timing(results, "first_byte", time.perf_counter() - start)
+                if kind != "api" or not self.retry_policy.can_retry(attempt):
+                    raise
+                delay = self.retry_policy.get_delay(attempt)
+                add_timing(results, "retry_wait", delay)
+                time.sleep(delay)
+                continue
+            add_timing(results, "first_byte", time.perf_counter() - start)
+            
+            if kind != "api" or not self.retry_policy.should_retry_status(r.status_code, attempt):
+                return r
+            
+            r.close()
+            delay = self.retry_policy.back_off(attempt, limiter=limiter, status_code=r.status_code, retry_after=r.headers.get("Retry-After"))
+            add_timing(results, "retry_wait", delay)
+            time.sleep(delay)
     
-    if r.status_code != 200:
-        return None
-   
-    return r.json()["posts"]
+    def get_info_json(self, post_id, auth=None, user_agent=None):
+        url = build_post_url(post_id, base_url=self.base_url)
+        
+        if self.cache != None:
+            post = self.cache.get(post_id)
+            if post != None:
+                return post
+        
+        r = self.get(url, auth=auth, user_agent=user_agent)
+        
+        if r.status_code in self.retry_policy.retry_statuses:
+            r.raise_for_status()
+        if r.status_code != 200:
+            return None
+        
+        post = r.json()["post"]
+        if self.cache != None:
+            self.cache.put(post)
+        return post
+    
+    def get_info_json_multiple(self, page=None, page_modifier=None, limit=None, include_deleted=False, tags=None, auth=None, user_agent=None):
+        url = build_posts_url(page=page, page_modifier=page_modifier, limit=limit, include_deleted=include_deleted, tags=tags, base_url=self.base_url)
+        
+        # Get the data
+        r = self.get(url, auth=auth, user_agent=user_agent)
+        
+        if r.status_code in self.retry_policy.retry_statuses:
+            r.raise_for_status()
+        if r.status_code != 200:
+            return None
+        
+        posts = r.json()["posts"]
+        if self.cache != None:
+            self.cache.put_many(posts)
+        return posts
+    
+    def get_info_json_batch(self, post_ids, batch_size=__e621_posts_per_request_limit__, auth=None, user_agent=None):
+        if type(batch_size) != int or batch_size < 1 or batch_size > __e621_posts_per_request_limit__:
+            raise ValueError("The 'batch_size' parameter must be an integer between 1 and {}".format(__e621_posts_per_request_limit__))
+        
+        post_ids = list(dict.fromkeys(post_ids))
+        for post_id in post_ids:
+            if type(post_id) != int:
+                raise TypeError("'post_ids' must only contain integers.")
+        
+        found = dict()
+        if self.cache != None:
+            found.update(self.cache.get_many(post_ids))
+        
+        # One search per chunk instead of one request per post, deleted posts included so they can be reported
+        missing = [post_id for post_id in post_ids if post_id not in found]
+        for i in range(0, len(missing), batch_size):
+            chunk = missing[i:i + batch_size]
+            tags = "id:{}".format(",".join(str(post_id) for post_id in chunk))
+            posts = self.get_info_json_multiple(limit=len(chunk), include_deleted=True, tags=tags, auth=auth, user_agent=user_agent)
+            if posts == None:
+                raise ConnectionError("Could not get posts batch ({} to {})".format(chunk[0], chunk[-1]))
+            for post in posts:
+                found[post["id"]] = post
+        
+        return {
+            "posts": [found[post_id] for post_id in post_ids if post_id in found],
+            "missing": [post_id for post_id in post_ids if post_id not in found],
+            "deleted": [post_id for post_id in post_ids if post_id in found and found[post_id]["flags"]["deleted"]]
+        }
+    
+    def iter_posts(self, tags=None, limit=None, page_size=__e621_posts_per_request_limit__, before_id=None, after_id=None, include_deleted=False, prefetch=True, auth=None, user_agent=None):
+        if limit != None and (type(limit) != int or limit < 0):
+            raise ValueError("The 'limit' parameter must be a positive integer")
+        if before_id != None and after_id != None:
+            raise ValueError("Only one of the 'before_id' and 'after_id' parameters can be used")
+        if limit == 0:
+            return
+        if limit != None:
+            page_size = min(page_size, limit)
+        
+        # Newest first by default, or oldest first when paging forward from after_id
+        if after_id != None:
+            cursor_modifier = "a"
+        else:
+            cursor_modifier = "b"
+        
+        def get_page(cursor):
+            if cursor == None:
+                page_modifier = None
+            else:
+                page_modifier = cursor_modifier
+            posts = self.get_info_json_multiple(page=cursor, page_modifier=page_modifier, limit=page_size, include_deleted=include_deleted, tags=tags, auth=auth, user_agent=user_agent)
+            if posts == None:
+                raise ConnectionError("Could not get posts page (tags={}, page={}{})".format(tags, cursor_modifier, cursor))
+            if after_id != None:
+                posts.sort(key=lambda post: post["id"])
+            return posts
+        
+        # Fetch the next page in the background while the current one is consumed
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(get_page, before_id if after_id == None else after_id)
+            count = 0
+            while next_page != None:
+                posts = next_page.result()
+                next_page = None
+                if len(posts) == 0:
+                    break
+                
+                if len(posts) >= page_size and (limit == None or count + len(posts) < limit):
+                    if after_id != None:
+                        cursor = posts[-1]["id"]
+                    else:
+                        cursor = min(post["id"] for post in posts)
+                    if prefetch:
+                        next_page = executor.submit(get_page, cursor)
+                    else:
+                        next_page = concurrent.futures.Future()
+                        next_page.set_result(get_page(cursor))
+                
+                for post in posts:
+                    if limit != None and count >= limit:
+                        return
+                    count += 1
+                    yield post
+    
+    def download_file(self, url, filename, user_agent=None, timeout=None, chunk_size=__default_chunk_size__, md5=None, results=None, bandwidth_limiter=None):
+        # Stream into a partial file, resuming it if an earlier attempt was cut off
+        part_path = get_part_path(filename)
+        part_size = get_file_size(part_path)
+        
+        headers = dict()
+        if part_size > 0:
+            headers["Range"] = "bytes={}-".format(part_size)
+        
+        r = self.get(url, user_agent=user_agent, timeout=timeout, stream=True, headers=headers, kind="file", results=results)
+        with r:
+            # The partial file is already the whole file
+            if r.status_code == 416:
+                finish_part_file(part_path, filename, md5=md5, hasher=hash_file(part_path, chunk_size=chunk_size))
+                return
+            r.raise_for_status()
+            
+            # The server ignored the range request, so start over
+            if r.status_code != 206:
+                part_size = 0
+            
+            expected_size = r.headers.get("Content-Length")
+            if expected_size != None:
+                expected_size = part_size + int(expected_size)
+            
+            # Hash the bytes as they arrive, starting with any resumed part
+            if md5 != None and part_size > 0:
+                hasher = hash_file(part_path, chunk_size=chunk_size)
+            else:
+                hasher = hashlib.md5()
+            
+            # Bytes from a broken transfer still count, since they were received
+            transfer_start = time.perf_counter()
+            received_size = 0
+            try:
+                with open(part_path, "ab" if part_size > 0 else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        received_size += len(chunk)
+                        if bandwidth_limiter != None:
+                            bandwidth_limiter.acquire(len(chunk))
+                        if md5 != None:
+                            hasher.update(chunk)
+                    written_size = f.tell()
+            finally:
+                add_timing(results, "transfer", time.perf_counter() - transfer_start, size=received_size)
+        
+        if expected_size != None and written_size < expected_size:
+            raise requests.exceptions.ConnectionError("Download ended early ({} of {} bytes)".format(written_size, expected_size))
+        
+        finish_part_file(part_path, filename, md5=md5, hasher=hasher)
+    
+    def download_image(self, post_id, output_folder=".", name_pattern=__default_name_pattern__, add_tags=True, save_json=False, use_messages=False, use_warnings=True, custom_json=None, auth=None, download_timeout=__default_download_timeout__, user_agent=None, memory_limit_ratio=__default_memory_limit_ratio__, chunk_size=__default_chunk_size__, verify_md5=True, skip_existing=False, store=None, metadata_sink=None, scheduler=None, variant="file", tag_index=None, memory_governor=None):
+        results = self._download_image(post_id, output_folder=output_folder, name_pattern=name_pattern, add_tags=add_tags, save_json=save_json, use_messages=use_messages, use_warnings=use_warnings, custom_json=custom_json, auth=auth, download_timeout=download_timeout, user_agent=user_agent, memory_limit_ratio=memory_limit_ratio, chunk_size=chunk_size, verify_md5=verify_md5, skip_existing=skip_existing, store=store, metadata_sink=metadata_sink, scheduler=scheduler, variant=variant, tag_index=tag_index, memory_governor=memory_governor)
+        run_hooks(self.hooks, results)
+        return results
+    
+    def _download_image(self, post_id, output_folder=".", name_pattern=__default_name_pattern__, add_tags=True, save_json=False, use_messages=False, use_warnings=True, custom_json=None, auth=None, download_timeout=__default_download_timeout__, user_agent=None, memory_limit_ratio=__default_memory_limit_ratio__, chunk_size=__default_chunk_size__, verify_md5=True, skip_existing=False, store=None, metadata_sink=None, scheduler=None, variant="file", tag_index=None, memory_governor=None):
+        # Prepare results object
+        results = make_results(post_id)
+        
+        # Get information from e621 API
+        if custom_json != None:
+            image_info = custom_json
+        else:
+            print_if_true("    Getting info for e621 post...".format(post_id), use_messages)
+            image_info, seconds = timed_call(self.get_info_json, post_id, user_agent=user_agent, auth=auth)
+            add_timing(results, "fetch_info", seconds)
+        
+        image_path = prepare_download(post_id, image_info, results, output_folder=output_folder, name_pattern=name_pattern, save_json=save_json, metadata_sink=metadata_sink, use_messages=use_messages, skip_existing=skip_existing, chunk_size=chunk_size, variant=variant)
+        if image_path == None:
+            index_image(tag_index, post_id, image_info, results)
+            return results
+        
+        # Only the original file has an MD5 to check against
+        variant_info = get_variant_info(image_info, variant)
+        md5 = None
+        if verify_md5:
+            md5 = variant_info["md5"]
+        
+        # Download image, each unique file only once when there is a content store
+        print_if_true("    Downloading image...", use_messages)
+        if store != None:
+            object_path = store.get_object_path(variant_info["key"], variant_info["ext"])
+            with store.lock(object_path):
+                if store.has(object_path):
+                    print_if_true("        Image is already in the store.", use_messages)
+                    error = ""
+                else:
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    error = self._download_with_retries(variant_info["url"], object_path, user_agent=user_agent, timeout=download_timeout, chunk_size=chunk_size, md5=md5, use_messages=use_messages, results=results, scheduler=scheduler, size=variant_info["size"])
+            if error == "":
+                store.link(object_path, image_path)
+        else:
+            error = self._download_with_retries(variant_info["url"], image_path, user_agent=user_agent, timeout=download_timeout, chunk_size=chunk_size, md5=md5, use_messages=use_messages, results=results, scheduler=scheduler, size=variant_info["size"])
+        
+        if error != "":
+            results["error"] = error
+            return results
+        results["saved_image"] = True
+        results["path_image"] = image_path
+        index_image(tag_index, post_id, image_info, results)
+        
+        # Try to save metadata directly in the same file
+        if add_tags:
+            results["saved_tags"], seconds = timed_call(tag_image, image_path, post_id, image_info, base_url=self.base_url, use_messages=use_messages, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio, verify_md5=verify_md5, store=store, variant=variant, memory_governor=memory_governor)
+            add_timing(results, "embed", seconds)
+        elif md5 != None:
+            mark_verified(image_path, md5)
+        
+        print_if_true("    Done downloading! Location: {}".format(image_path), use_messages)
+        return results
+    
+    def _download_with_retries(self, url, filename, user_agent=None, timeout=None, chunk_size=__default_chunk_size__, md5=None, use_messages=False, results=None, scheduler=None, size=None):
+        if scheduler == None:
+            return self._retry_download(url, filename, user_agent=user_agent, timeout=timeout, chunk_size=chunk_size, md5=md5, use_messages=use_messages, results=results)
+        
+        # Wait for a transfer slot and charge the byte budget
+        try:
+            with scheduler.transfer(size or 0, results=results):
+                return self._retry_download(url, filename, user_agent=user_agent, timeout=timeout, chunk_size=chunk_size, md5=md5, use_messages=use_messages, results=results, bandwidth_limiter=scheduler.bandwidth_limiter)
+        except ByteBudgetError as e:
+            print_if_true("        {}, skipping.".format(e), use_messages)
+            return format_error(e)
+    
+    def _retry_download(self, url, filename, user_agent=None, timeout=None, chunk_size=__default_chunk_size__, md5=None, use_messages=False, results=None, bandwidth_limiter=None):
+        attempt = 0
+        while True:
+            attempt += 1
+            status_code = None
+            retry_after = None
+            try:
+                self.download_file(url, filename, user_agent=user_agent, timeout=timeout, chunk_size=chunk_size, md5=md5, results=results, bandwidth_limiter=bandwidth_limiter)
+                return ""
+            except requests.exceptions.Timeout as e:
+                error = e
+                message = "Download timed out"
+            except requests.exceptions.ConnectionError as e:
+                error = e
+                message = "Download timed out"
+            except requests.exceptions.ChunkedEncodingError as e:
+                error = e
+                message = "Download was cut off"
+            except MD5MismatchError as e:
+                error = e
+                message = "Downloaded file was corrupt"
+            except requests.exceptions.HTTPError as e:
+                error = e
+                message = "Server error"
+                if e.response != None:
+                    status_code = e.response.status_code
+                    retry_after = e.response.headers.get("Retry-After")
+            
+            failed = give_up_download(self.retry_policy, attempt, message, error, filename, status_code=status_code, use_messages=use_messages)
+            if failed != None:
+                return failed
+            delay = self.retry_policy.back_off(attempt, limiter=self.file_limiter, status_code=status_code, retry_after=retry_after)
+            add_timing(results, "retry_wait", delay)
+            time.sleep(delay)
+    
+    def _download_image_safe(self, item, **kwargs):
+        # A single failing post must not take down the rest of the batch
+        post_id = get_item_id(item)
+        try:
+            return self._download_image(post_id, custom_json=get_item_json(item), **kwargs)
+        except Exception as e:
+            return make_error_results(post_id, e)
+    
+    def _fetch_stage(self, item, tag_executor, **kwargs):
+        # Download without tags, then hand the file to the tagging pool and move on
+        post_id = get_item_id(item)
+        image_info = get_item_json(item)
+        try:
+            fetch_seconds = None
+            if image_info == None:
+                image_info, fetch_seconds = timed_call(self.get_info_json, post_id, auth=kwargs.get("auth"), user_agent=kwargs.get("user_agent"))
+            if image_info == None:
+                results = make_results(post_id)
+                results["post_exists"] = False
+                add_timing(results, "fetch_info", fetch_seconds)
+                return results, None
+            
+            results = self._download_image(post_id, custom_json=image_info, add_tags=False, **kwargs)
+            if fetch_seconds != None:
+                add_timing(results, "fetch_info", fetch_seconds)
+        except Exception as e:
+            return make_error_results(post_id, e), None
+        
+        if not results["saved_image"] or results["skipped_image"]:
+            return results, None
+        
+        # Tagging threads wait for memory themselves, but a process pool can't share the governor, so memory is reserved here for it
+        memory_governor = kwargs.get("memory_governor")
+        tag_governor = memory_governor
+        reserved = None
+        if memory_governor != None and isinstance(tag_executor, concurrent.futures.ProcessPoolExecutor):
+            tag_governor = None
+            reserved = estimate_embed_memory(results["path_image"], image_info, variant=kwargs.get("variant", "file"))
+            memory_governor.acquire(reserved)
+        
+        try:
+            tag_future = tag_executor.submit(timed_call, tag_image, results["path_image"], post_id, image_info, base_url=self.base_url, use_warnings=kwargs.get("use_warnings", True), memory_limit_ratio=kwargs.get("memory_limit_ratio", __default_memory_limit_ratio__), verify_md5=kwargs.get("verify_md5", True), store=kwargs.get("store"), variant=kwargs.get("variant", "file"), memory_governor=tag_governor)
+        except Exception:
+            if reserved != None:
+                memory_governor.release(reserved)
+            raise
+        if reserved != None:
+            tag_future.add_done_callback(lambda future: memory_governor.release(reserved))
+        return results, tag_future
+    
+    def iter_download_images(self, items, workers=__default_workers__, tag_workers=None, tag_processes=False, journal=None, resume=False, ordered=True, **kwargs):
+        if type(workers) != int or workers < 1:
+            raise ValueError("The 'workers' parameter must be an integer greater than 0")
+        if tag_workers != None and (type(tag_workers) != int or tag_workers < 1):
+            raise ValueError("The 'tag_workers' parameter must be an integer greater than 0, or None to tag on the download workers")
+        if resume and journal == None:
+            raise ValueError("A 'journal' is needed to resume")
+        
+        # Skip posts the journal already has as complete, and record every result in it
+        if resume:
+            completed = journal.get_completed()
+            items = (item for item in items if get_item_id(item) not in completed)
+        
+        if kwargs.get("scheduler") != None:
+            items = kwargs["scheduler"].schedule(items)
+        
+        for results in self._iter_download_images(items, workers, tag_workers, tag_processes, ordered, **kwargs):
+            if journal != None:
+                journal.record(results, add_tags=kwargs.get("add_tags", True))
+            run_hooks(self.hooks, results)
+            yield results
+        
+        if journal != None:
+            journal.flush()
+    
+    def _iter_download_images(self, items, workers, tag_workers, tag_processes, ordered, **kwargs):
+        # Large posts get their own few workers, so waiting for a large transfer slot never holds up the rest
+        scheduler = kwargs.get("scheduler")
+        if scheduler != None and scheduler.max_large_transfers != None:
+            large_executor = concurrent.futures.ThreadPoolExecutor(max_workers=scheduler.max_large_transfers)
+        else:
+            large_executor = None
+        
+        def pick_executor(executor, item):
+            if large_executor != None and scheduler.is_large(item):
+                return large_executor
+            return executor
+        
+        try:
+            yield from self._iter_pipeline(items, workers, tag_workers, tag_processes, ordered, pick_executor, **kwargs)
+        finally:
+            if large_executor != None:
+                large_executor.shutdown()
+    
+    def _iter_pipeline(self, items, workers, tag_workers, tag_processes, ordered, pick_executor, **kwargs):
+        if tag_workers == None or not kwargs.get("add_tags", True):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                yield from iter_bounded(lambda item: pick_executor(executor, item).submit(self._download_image_safe, item, **kwargs), items, workers * 2, ordered=ordered)
+            return
+        
+        # Two stage pipeline, so slow embedding never holds up the next transfer
+        kwargs.pop("add_tags", None)
+        if tag_processes and kwargs.get("memory_governor") != None and kwargs["memory_governor"].limit_process:
+            # Each process gets the same address space limit as this one
+            tag_executor = concurrent.futures.ProcessPoolExecutor(max_workers=tag_workers, initializer=set_memory_limit, initargs=(kwargs["memory_governor"].budget,))
+        elif tag_processes:
+            tag_executor = concurrent.futures.ProcessPoolExecutor(max_workers=tag_workers)
+        else:
+            tag_executor = concurrent.futures.ThreadPoolExecutor(max_workers=tag_workers)
+        
+        with tag_executor, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for results, tag_future in iter_bounded(lambda item: pick_executor(executor, item).submit(self._fetch_stage, item, tag_executor, **kwargs), items, (workers + tag_workers) * 2, ordered=ordered):
+                yield finish_tag_stage(results, tag_future)
+    
+    def download_images(self, items, workers=__default_workers__, tag_workers=None, tag_processes=False, journal=None, resume=False, ordered=True, **kwargs):
+        return list(self.iter_download_images(items, workers=workers, tag_workers=tag_workers, tag_processes=tag_processes, journal=journal, resume=resume, ordered=ordered, **kwargs))
+    
+    def iter_sync(self, tags, state, recheck=0, limit=None, include_deleted=False, auth=None, user_agent=None, **kwargs):
+        if type(recheck) != int or recheck < 0:
+            raise ValueError("The 'recheck' parameter must be a positive integer")
+        
+        high_water = state.get_high_water(tags)
+        handed_out = list()
+        completed = dict()
+        digests = dict()
+        
+        def get_changed_posts():
+            # Re-check the newest posts that were already synced, for updated tags or deletions
+            if high_water == None or recheck == 0:
+                return list()
+            posts = list(self.iter_posts(tags=tags, limit=recheck, before_id=high_water + 1, include_deleted=True, auth=auth, user_agent=user_agent))
+            known = state.get_digests(post["id"] for post in posts)
+            changed = list()
+            for post in posts:
+                digests[post["id"]] = get_sync_digest(post, base_url=self.base_url)
+                if known.get(post["id"]) != digests[post["id"]]:
+                    changed.append(post)
+            return changed
+        
+        def get_new_posts():
+            # Posts the journal already has as complete are skipped by a resume without a result, but still count as done here
+            if kwargs.get("resume") and kwargs.get("journal") != None:
+                journaled = kwargs["journal"].get_completed()
+            else:
+                journaled = set()
+            for post in self.iter_posts(tags=tags, limit=limit, after_id=high_water or 0, include_deleted=include_deleted, auth=auth, user_agent=user_agent):
+                handed_out.append(post["id"])
+                digests[post["id"]] = get_sync_digest(post, base_url=self.base_url)
+                if post["id"] in journaled:
+                    completed[post["id"]] = digests[post["id"]]
+                yield post
+        
+        def record(results):
+            if is_complete(results, add_tags=kwargs.get("add_tags", True)):
+                completed[results["post_id"]] = digests[results["post_id"]]
+            return results
+        
+        # Changed posts are downloaded again, since the file on disk has the old tags embedded
+        try:
+            changed_kwargs = dict(kwargs, skip_existing=False, resume=False)
+            for results in self.iter_download_images(get_changed_posts(), auth=auth, user_agent=user_agent, **changed_kwargs):
+                yield record(results)
+            for results in self.iter_download_images(get_new_posts(), auth=auth, user_agent=user_agent, **kwargs):
+                yield record(results)
+        finally:
+            # Only move the high-water mark past posts that are done, and every post before them
+            new_high_water = high_water
+            for post_id in handed_out:
+                if post_id not in completed:
+                    break
+                new_high_water = post_id
+            state.update(tags, high_water=new_high_water, digests=completed)
+    
+    def sync(self, tags, state, recheck=0, limit=None, include_deleted=False, auth=None, user_agent=None, **kwargs):
+        return list(self.iter_sync(tags, state, recheck=recheck, limit=limit, include_deleted=include_deleted, auth=auth, user_agent=user_agent, **kwargs))
+    
+    def iter_download_shards(self, tags, coordinator, shard_size=__default_shard_size__, worker_id=None, auth=None, user_agent=None, **kwargs):
+        if worker_id == None:
+            worker_id = get_worker_id()
+        
+        # A shard can be picked up again after part of it was downloaded, so don't download those posts twice
+        kwargs.setdefault("skip_existing", True)
+        
+        # Any worker can extend the plan up to the newest post, planning is idempotent
+        newest = self.get_info_json_multiple(limit=1, tags=tags, auth=auth, user_agent=user_agent)
+        if newest == None:
+            raise ConnectionError("Could not get the newest post (tags={})".format(tags))
+        if len(newest) > 0:
+            coordinator.plan(tags, newest[0]["id"], shard_size=shard_size)
+        
+        while True:
+            shard = coordinator.claim(tags, worker_id)
+            if shard == None:
+                return
+            yield from self._download_shard(tags, coordinator, shard, worker_id, auth=auth, user_agent=user_agent, **kwargs)
+    
+    def _download_shard(self, tags, coordinator, shard, worker_id, auth=None, user_agent=None, **kwargs):
+        handed_out = list()
+        failed = set()
+        done = set()
+        finished = False
+        
+        lease = coordinator.lease(shard, worker_id)
+        
+        def get_posts():
+            # Page forward from the cursor, and stop handing out posts once the lease is gone
+            for post in self.iter_posts(tags=get_shard_tags(tags, shard["high"]), after_id=shard["cursor"], auth=auth, user_agent=user_agent):
+                if post["id"] >= shard["high"] or lease.lost.is_set():
+                    return
+                handed_out.append(post["id"])
+                yield post
+        
+        try:
+            with lease:
+                done_count = 0
+                for results in self.iter_download_images(get_posts(), auth=auth, user_agent=user_agent, **kwargs):
+                    if is_complete(results, add_tags=kwargs.get("add_tags", True)):
+                        done.add(results["post_id"])
+                    else:
+                        failed.add(results["post_id"])
+                    
+                    # The cursor covers every post up to the first one that isn't done
+                    while done_count < len(handed_out) and handed_out[done_count] in done:
+                        lease.cursor = handed_out[done_count]
+                        done_count += 1
+                    yield results
+                finished = True
+        finally:
+            # Failed posts get another try from the cursor later, until the shard is out of attempts
+            if lease.lost.is_set():
+                pass
+            elif not finished or (len(failed) > 0 and shard["attempts"] < coordinator.max_attempts):
+                coordinator.release(shard, worker_id, cursor=lease.cursor)
+            else:
+                coordinator.complete(shard, worker_id, failed=len(failed))
+    
+    def download_shards(self, tags, coordinator, shard_size=__default_shard_size__, worker_id=None, auth=None, user_agent=None, **kwargs):
+        return list(self.iter_download_shards(tags, coordinator, shard_size=shard_size, worker_id=worker_id, auth=auth, user_agent=user_agent, **kwargs))
+
+def iter_bounded(submit, items, window, ordered=True):
+    # Keep a bounded window of work in flight, and yield results in input order or as soon as they are done
+    pending = collections.deque()
+    for item in items:
+        pending.append(submit(item))
+        while len(pending) >= window:
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+    
+    if ordered:
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    else:
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+# Module-level functions are thin wrappers over a shared default client
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_default_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client == None:
+            _default_client = Client()
+        return _default_client
+
+def set_default_client(client):
+    global _default_client
+    if client != None and not isinstance(client, Client):
+        raise TypeError("'client' must be a dl621.Client instance or None")
+    with _default_client_lock:
+        _default_client = client
+
+def get_info_json(post_id, auth=None, user_agent=__default_user_agent__, client=None):
+    if client == None:
+        client = get_default_client()
+    return client.get_info_json(post_id, auth=auth, user_agent=user_agent)
+
+def get_info_json_multiple(page=None, page_modifier=None, limit=None, include_deleted=False, tags=None, auth=None, user_agent=__default_user_agent__, client=None):
+    if client == None:
+        client = get_default_client()
+    return client.get_info_json_multiple(page=page, page_modifier=page_modifier, limit=limit, include_deleted=include_deleted, tags=tags, auth=auth, user_agent=user_agent)
+
+# One shared prefix string per tag category, instead of formatting it again for every tag
+_tag_prefixes = dict()
+
+def get_tag_prefix(tag_cat):
+    prefix = _tag_prefixes.get(tag_cat)
+    if prefix == None:
+        prefix = sys.intern("{}: ".format(tag_cat))
+        _tag_prefixes[tag_cat] = prefix
+    return prefix
 
-def get_tags_from_json(info_json):
+def get_tags_from_json(info_json, structured=False):
+    if structured:
+        return get_structured_tags_from_json(info_json)
+    
     post_id = info_json["id"]
     tags_src_obj = info_json["tags"]
     
     tags_out = list()
     
-    # Regular tags
-    for tag_cat in tags_src_obj.keys():
-        tags_in_cat = tags_src_obj[tag_cat]
-        for curr_tag in tags_in_cat:
-            if tag_cat == "general":
-                tags_out.append(curr_tag)
-            else:
-                tags_out.append("{}: {}".format(tag_cat, curr_tag))
+    # Regular tags, added a whole category at a time
+    for tag_cat, tags_in_cat in tags_src_obj.items():
+        if tag_cat == "general":
+            tags_out += tags_in_cat
+        elif len(tags_in_cat) > 0:
+            prefix = get_tag_prefix(tag_cat)
+            tags_out += [prefix + curr_tag for curr_tag in tags_in_cat]
     
     # Parent and child tags
     parent = info_json["relationships"]["parent_id"]
     children = info_json["relationships"]["children"]
     
     if parent != None:
-        tags_out.append("post_parent: {}".format(parent))
+        tags_out.append("post_parent: " + str(parent))
     
-    if len(children) > 0:
-        for child in children:
-            tags_out.append("post_child: {}".format(child))
+    for child in children:
+        tags_out.append("post_child: " + str(child))
     
     # Site and ID tags
     tags_out.append("post_site: e621.net")
-    tags_out.append("post_id: {}".format(post_id))
+    tags_out.append("post_id: " + str(post_id))
     
     # MD5 tag
-    tags_out.append("md5: {}".format(info_json["file"]["md5"]))
+    tags_out.append("md5: " + str(info_json["file"]["md5"]))
     
     # Rating tag
-    tags_out.append("rating: {}".format(info_json["rating"]))
+    tags_out.append("rating: " + str(info_json["rating"]))
     
     # Pool tags
     for pool in info_json["pools"]:
-        tags_out.append("pool: {}".format(pool))
+        tags_out.append("pool: " + str(pool))
     
     # Sources tags
     for source in info_json["sources"]:
-        tags_out.append("source: {}".format(source))
+        tags_out.append("source: " + str(source))
     
     return tags_out
 
-def download_file(url, filename, user_agent=__default_user_agent__):
-    opener = urllib.request.URLopener()
-    opener.addheader('User-Agent', user_agent)
-    filename, headers = opener.retrieve(url, filename)
+def get_structured_tags_from_json(info_json):
+    # The same tags grouped by category, as tuples since the garbage collector stops tracking tuples of strings
+    tags_out = dict()
+    for tag_cat, tags_in_cat in info_json["tags"].items():
+        tags_out[tag_cat] = tuple(tags_in_cat)
+    
+    parent = info_json["relationships"]["parent_id"]
+    if parent != None:
+        tags_out["post_parent"] = (str(parent),)
+    tags_out["post_child"] = tuple([str(child) for child in info_json["relationships"]["children"]])
+    tags_out["post_site"] = ("e621.net",)
+    tags_out["post_id"] = (str(info_json["id"]),)
+    tags_out["md5"] = (str(info_json["file"]["md5"]),)
+    tags_out["rating"] = (str(info_json["rating"]),)
+    tags_out["pool"] = tuple([str(pool) for pool in info_json["pools"]])
+    tags_out["source"] = tuple([str(source) for source in info_json["sources"]])
+    return tags_out
+
+def flatten_tags(structured_tags):
+    tags_out = list()
+    for tag_cat, tags_in_cat in structured_tags.items():
+        if tag_cat == "general":
+            tags_out += tags_in_cat
+        elif len(tags_in_cat) > 0:
+            prefix = get_tag_prefix(tag_cat)
+            tags_out += [prefix + curr_tag for curr_tag in tags_in_cat]
+    return tags_out
+
+def get_tags_from_json_batch(posts, structured=False):
+    # Look the function up once for the whole batch
+    if structured:
+        convert = get_structured_tags_from_json
+    else:
+        convert = get_tags_from_json
+    return [convert(info_json) for info_json in posts]
+
+def get_info_json_batch(post_ids, batch_size=__e621_posts_per_request_limit__, auth=None, user_agent=__default_user_agent__, client=None):
+    if client == None:
+        client = get_default_client()
+    return client.get_info_json_batch(post_ids, batch_size=batch_size, auth=auth, user_agent=user_agent)
+
+def iter_posts(tags=None, limit=None, page_size=__e621_posts_per_request_limit__, before_id=None, after_id=None, include_deleted=False, prefetch=True, auth=None, user_agent=__default_user_agent__, client=None):
+    if client == None:
+        client = get_default_client()
+    return client.iter_posts(tags=tags, limit=limit, page_size=page_size, before_id=before_id, after_id=after_id, include_deleted=include_deleted, prefetch=prefetch, auth=auth, user_agent=user_agent)
+
+def download_file(url, filename, user_agent=__default_user_agent__, timeout=None, chunk_size=__default_chunk_size__, md5=None, results=None, bandwidth_limiter=None, client=None):
+    if client == None:
+        client = get_default_client()
+    client.download_file(url, filename, user_agent=user_agent, timeout=timeout, chunk_size=chunk_size, md5=md5, results=results, bandwidth_limiter=bandwidth_limiter)
 
 def print_if_true(in_string, do_print):
     if do_print:
         print(in_string)
-def download_image(post_id, output_folder=".", name_pattern=__default_name_pattern__, add_tags=True, save_json=False, use_messages=False, use_warnings=True, custom_json=None, auth=None, download_timeout=__default_download_timeout__, user_agent=__default_user_agent__, memory_limit_ratio=__default_memory_limit_ratio__):
-    # Prepare results object
-    results = {
-        "post_exists": True,
-        "post_deleted": False,
-        "post_missing_url": False,
-        "saved_image": False,
-        "saved_tags": False,
-        "saved_json": False,
-        "path_image": "",
-        "path_json": ""
-    }
-    
-    # Get information from e621 API
-    if custom_json != None:
-        image_info = custom_json
-    else:
-        print_if_true("    Getting info for e621 post...".format(post_id), use_messages)
-        image_info = get_info_json(post_id, user_agent=user_agent, auth=auth)
-    
+
+def prepare_download(post_id, image_info, results, output_folder=".", name_pattern=__default_name_pattern__, save_json=False, metadata_sink=None, use_messages=False, skip_existing=False, chunk_size=__default_chunk_size__, variant="file"):
     # Check to make sure we got a response
     if image_info == None:
         print_if_true("    ERROR: No info returned.", use_messages)
         results["post_exists"] = False
-        return results
+        return None
+    
+    variant_info = get_variant_info(image_info, variant)
+    results["variant"] = variant_info["variant"]
+    
+    # Samples and previews get their own names, so they never overwrite an original
+    if variant_info["variant"] != "file" and "{v}" not in name_pattern:
+        name_pattern += "_{v}"
     
     # Build file name
-    image_name_base = name_pattern.format(m = image_info["file"]["md5"], i = post_id)
-    image_name = image_name_base + os.path.extsep + image_info["file"]["ext"]
+    image_name_base = name_pattern.format(m = image_info["file"]["md5"], i = post_id, v = variant_info["variant"])
+    image_name = image_name_base + os.path.extsep + variant_info["ext"]
     image_path = os.path.join(output_folder, image_name)
     
     # Save the metadata in a seperate file
     if save_json:
         json_path = image_path + os.path.extsep + "json"
         print_if_true("    Saving metadata JSON...", use_messages)
+        start = time.perf_counter()
         with open(json_path, "w") as f:
             json.dump(image_info, f, indent=4)
+            json_size = f.tell()
+        add_timing(results, "json", time.perf_counter() - start, size=json_size)
         results["saved_json"] = True
         results["path_json"] = json_path
         print_if_true("    Saved metadata! Location: {}".format(json_path), use_messages)
-        
+    
+    # Append it to a shared sink as well, like MetadataShards
+    if metadata_sink != None:
+        start = time.perf_counter()
+        shard_path = metadata_sink.write(image_info)
+        add_timing(results, "json", time.perf_counter() - start)
+        results["saved_json"] = True
+        if results["path_json"] == "":
+            results["path_json"] = shard_path
+        print_if_true("    Saved metadata! Location: {}".format(shard_path), use_messages)
     
     # Check to see if the file was deleted
     if image_info["flags"]["deleted"]:
         print_if_true("    ERROR: Image has been deleted.", use_messages)
         results["post_deleted"] = True
-        return results
-    image_url = image_info["file"]["url"]
+        return None
     
     # Check to see if there is no download URL
-    if image_url == None:
+    if variant_info["url"] == None:
         print_if_true("    ERROR: Image has no download URL. You may need to use your API key or change your user settings.", use_messages)
         results["post_missing_url"] = True
-        return results
+        return None
+    
+    # Check to see if a matching file was already downloaded, samples and previews can only be checked for by name
+    if variant_info["variant"] == "file":
+        downloaded = skip_existing and is_verified(image_path, variant_info["md5"], chunk_size=chunk_size)
+    else:
+        downloaded = skip_existing and os.path.isfile(image_path)
+    if downloaded:
+        print_if_true("    Image already downloaded, skipping. Location: {}".format(image_path), use_messages)
+        results["saved_image"] = True
+        results["skipped_image"] = True
+        results["path_image"] = image_path
+        return None
     
     # Create destination folder if it doesn't already exist
     #output_folder = os.path.realpath(output_folder)
     os.makedirs(output_folder, exist_ok=True)
     
-    # Download image
-    print_if_true("    Downloading image...", use_messages)
-    original_timeout = socket.getdefaulttimeout()
-    socket.setdefaulttimeout(download_timeout)
-    while not results["saved_image"]:
-        try:
-            download_file(image_url, image_path, user_agent=user_agent)
-            results["saved_image"] = True
-            results["path_image"] = image_path
-        except socket.timeout:
-            print_if_true("        Download timed out, retrying...", use_messages)
-        except urllib.error.URLError:
-            print_if_true("        Download timed out, retrying...", use_messages)
-    socket.setdefaulttimeout(original_timeout)
-    
-    # Try to save metadata directly in the same file
-    if add_tags:
-        print_if_true("    Trying to embed metadata...", use_messages)
+    return image_path
+
+def index_image(tag_index, post_id, image_info, results):
+    # Only images that are on disk go in the index
+    if tag_index != None and results["saved_image"]:
+        tag_index.add(post_id, get_tags_from_json(image_info), path=results["path_image"])
+
+def get_metadata(post_id, image_info, base_url=__e621_base_url__):
+    title = "{}{}/{}".format(base_url, __e621_endpoint_posts__, post_id)
+    description = image_info["description"].strip()
+    image_tags = get_tags_from_json(image_info)
+    return title, description, image_tags
+
+def get_metadata_digest(post_id, image_info, base_url=__e621_base_url__):
+    metadata = json.dumps(get_metadata(post_id, image_info, base_url=base_url), separators=(",", ":"))
+    return hashlib.sha1(metadata.encode()).hexdigest()[:16]
+
+def get_sync_digest(image_info, base_url=__e621_base_url__):
+    # Changes to anything that is embedded, or the post being deleted, mean it has to be synced again
+    return "{}{}".format(get_metadata_digest(image_info["id"], image_info, base_url=base_url), "d" if image_info["flags"]["deleted"] else "")
+
+def embed_metadata(image_path, post_id, image_info, base_url=__e621_base_url__, use_messages=False, use_warnings=True, memory_limit_ratio=__default_memory_limit_ratio__):
+    print_if_true("    Trying to embed metadata...", use_messages)
+    try:
+        image_tags_obj = imgtag.ImgTag(image_path, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio)
+        title, description, image_tags = get_metadata(post_id, image_info, base_url=base_url)
+        
+        # Set title
+        image_tags_obj.set_title(title)
+
+        # Set description
+        if len(description) > 0:
+            image_tags_obj.set_description(description)
+
+        # Set tags
+        image_tags_obj.add_tags(image_tags)
+        return image_tags_obj.close()
+    except SystemError:
+        print_if_true("        [FAILED] Could not save metadata in image!", use_messages)
+        if use_warnings == True:
+            warnings.warn("Could not save metadata in image!")
+        return False
+
+def tag_image(image_path, post_id, image_info, base_url=__e621_base_url__, use_messages=False, use_warnings=True, memory_limit_ratio=__default_memory_limit_ratio__, verify_md5=True, store=None, variant="file", memory_governor=None):
+    # The governor caps every embed in the process together, instead of each one on its own
+    if memory_governor != None:
+        with memory_governor.reserve(estimate_embed_memory(image_path, image_info, variant=variant)):
+            return tag_image(image_path, post_id, image_info, base_url=base_url, use_messages=use_messages, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio, verify_md5=verify_md5, store=store, variant=variant)
+    
+    # Under a process-wide limit, imgtag must not lower it any further, and has to have it put back once it is done
+    if get_memory_limit() != None:
+        memory_limit_ratio = __governed_memory_limit_ratio__
+    try:
+        if store != None:
+            saved_tags = tag_stored_image(store, image_path, post_id, image_info, base_url=base_url, use_messages=use_messages, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio, variant=variant)
+        else:
+            saved_tags = embed_metadata(image_path, post_id, image_info, base_url=base_url, use_messages=use_messages, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio)
+    finally:
+        restore_memory_limit()
+    
+    # Embedding changes the file, so it has to be marked as verified again
+    variant_info = get_variant_info(image_info, variant)
+    if verify_md5 and variant_info["md5"] != None:
+        mark_verified(image_path, variant_info["md5"])
+    return saved_tags
+
+def tag_stored_image(store, image_path, post_id, image_info, base_url=__e621_base_url__, use_messages=False, use_warnings=True, memory_limit_ratio=__default_memory_limit_ratio__, variant="file"):
+    # Outputs with the same embedded metadata share one tagged copy in the store
+    variant_info = get_variant_info(image_info, variant)
+    md5 = variant_info["key"]
+    ext = variant_info["ext"]
+    tagged_path = store.get_tagged_path(md5, ext, get_metadata_digest(post_id, image_info, base_url=base_url))
+    
+    with store.lock(tagged_path):
+        if store.has(tagged_path):
+            print_if_true("    Tagged image is already in the store.", use_messages)
+        else:
+            # The untagged object is kept for other metadata, which costs a second full copy without reflinks
+            temp_path = store.get_temp_path(tagged_path)
+            store.clone(store.get_object_path(md5, ext), temp_path)
+            if not embed_metadata(temp_path, post_id, image_info, base_url=base_url, use_messages=use_messages, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio):
+                os.remove(temp_path)
+                return False
+            os.replace(temp_path, tagged_path)
+    
+    store.link(tagged_path, image_path)
+    return True
+
+def finish_tag_stage(results, tag_future):
+    if tag_future != None:
         try:
-            image_tags_obj = imgtag.ImgTag(image_path, use_warnings=use_warnings, memory_limit_ratio=memory_limit_ratio)
-            
-            # Set title
-            title = "{}{}/{}".format(__e621_base_url__, __e621_endpoint_posts__, post_id)
-            image_tags_obj.set_title(title)
-
-            # Set description
-            description = image_info["description"].strip()
-            if len(description) > 0:
-                image_tags_obj.set_description(description)
-
-            # Set tags
-            image_tags = get_tags_from_json(image_info)
-            image_tags_obj.add_tags(image_tags)
-            results["saved_tags"] = image_tags_obj.close()
-        except SystemError:
-            print_if_true("        [FAILED] Could not save metadata in image!", use_messages)
-            if use_warnings == True:
-                warnings.warn("Could not save metadata in image!")
-    
-    print_if_true("    Done downloading! Location: {}".format(image_path), use_messages)
+            results["saved_tags"], seconds = tag_future.result()
+            add_timing(results, "embed", seconds)
+        except Exception as e:
+            results["error"] = format_error(e)
     return results
 
+def download_image(post_id, output_folder=".", name_pattern=__default_name_pattern__, add_tags=True, save_json=False, use_messages=False, use_warnings=True, custom_json=None, auth=None, download_timeout=__default_download_timeout__, user_agent=__default_user_agent__, memory_limit_ratio=__default_memory_limit_ratio__, chunk_size=__default_chunk_size__, verify_md5=True, skip_existing=False, store=None, metadata_sink=None, scheduler=None, variant="file", tag_index=None, memory_governor=None, client=None):
+    if client == None:
+        client = get_default_client()
+    return client.download_image(post_id, output_folder=output_folder, name_pattern=name_pattern, add_tags=add_tags, save_json=save_json, use_messages=use_messages, use_warnings=use_warnings, custom_json=custom_json, auth=auth, download_timeout=download_timeout, user_agent=user_agent, memory_limit_ratio=memory_limit_ratio, chunk_size=chunk_size, verify_md5=verify_md5, skip_existing=skip_existing, store=store, metadata_sink=metadata_sink, scheduler=scheduler, variant=variant, tag_index=tag_index, memory_governor=memory_governor)
+
+def iter_download_images(items, workers=__default_workers__, tag_workers=None, tag_processes=False, journal=None, resume=False, ordered=True, client=None, **kwargs):
+    if client == None:
+        client = get_default_client()
+    return client.iter_download_images(items, workers=workers, tag_workers=tag_workers, tag_processes=tag_processes, journal=journal, resume=resume, ordered=ordered, **kwargs)
+
+def download_images(items, workers=__default_workers__, tag_workers=None, tag_processes=False, journal=None, resume=False, ordered=True, client=None, **kwargs):
+    if client == None:
+        client = get_default_client()
+    return client.download_images(items, workers=workers, tag_workers=tag_workers, tag_processes=tag_processes, journal=journal, resume=resume, ordered=ordered, **kwargs)
+
+def iter_sync(tags, state, recheck=0, limit=None, include_deleted=False, auth=None, user_agent=__default_user_agent__, client=None, **kwargs):
+    if client == None:
+        client = get_default_client()
+    return client.iter_sync(tags, state, recheck=recheck, limit=limit, include_deleted=include_deleted, auth=auth, user_agent=user_agent, **kwargs)
+
+def sync(tags, state, recheck=0, limit=None, include_deleted=False, auth=None, user_agent=__default_user_agent__, client=None, **kwargs):
+    if client == None:
+        client = get_default_client()
+    return client.sync(tags, state, recheck=recheck, limit=limit, include_deleted=include_deleted, auth=auth, user_agent=user_agent, **kwargs)
+
+def iter_download_shards(tags, coordinator, shard_size=__default_shard_size__, worker_id=None, auth=None, user_agent=__default_user_agent__, client=None, **kwargs):
+    if client == None:
+        client = get_default_client()
+    return client.iter_download_shards(tags, coordinator, shard_size=shard_size, worker_id=worker_id, auth=auth, user_agent=user_agent, **kwargs)
+
+def download_shards(tags, coordinator, shard_size=__default_shard_size__, worker_id=None, auth=None, user_agent=__default_user_agent__, client=None, **kwargs):
+    if client == None:
+        client = get_default_client()
+    return client.download_shards(tags, coordinator, shard_size=shard_size, worker_id=worker_id, auth=auth, user_agent=user_agent, **kwargs)
+
 
 
 def dir_path(string):
@@ -256,21 +1253,284 @@ def dir_path(string):
 def parse_args(args):
     parser = argparse.ArgumentParser(description="Downloads e621 images with embedded XMP tags and description")
     
-    parser.add_argument("-i", "--post_id", dest="post_id", help="the ID of the e621 post", type=int, required=True, metavar="ID")
+    parser.add_argument("-i", "--post_id", dest="post_ids", help="the ID of the e621 post (can be repeated)", type=int, action="append", default=[], metavar="ID")
+    parser.add_argument("--ids-file", dest="ids_file", help="a file with one post ID per line ('-' for stdin)", type=str, default=None, metavar="FILE")
+    parser.add_argument("--tags", dest="tags", help="download every post matching a tag query", type=str, default=None, metavar="TAGS")
+    parser.add_argument("-l", "--limit", dest="limit", help="the maximum number of posts to download with --tags", type=int, default=None, metavar="LIMIT")
+    parser.add_argument("--sync", dest="sync", help="only download --tags posts newer than the last sync, keeping track of them in this file", type=str, default=None, metavar="STATE_FILE")
+    parser.add_argument("--coordinate", dest="coordinate", help="split --tags into post ID ranges leased from this shared file, so workers on several nodes can crawl it together", type=str, default=None, metavar="COORDINATOR_FILE")
+    parser.add_argument("--shard_size", dest="shard_size", help="how many post IDs each --coordinate shard covers", type=int, default=__default_shard_size__, metavar="IDS")
+    parser.add_argument("--lease_time", dest="lease_time", help="seconds until a shard whose worker stopped renewing it is handed out again", type=float, default=__default_lease_time__, metavar="SECONDS")
+    parser.add_argument("--recheck", dest="recheck", help="with --sync, also check this many already synced posts for new tags or deletions", type=int, default=0, metavar="POSTS")
+    parser.add_argument("-w", "--workers", dest="workers", help="how many posts to download at once", type=int, default=__default_workers__, metavar="WORKERS")
+    parser.add_argument("--tag_workers", dest="tag_workers", help="how many images to embed tags in at once, separately from the downloads", type=int, default=None, metavar="TAG_WORKERS")
+    parser.add_argument("--tag_processes", dest="tag_processes", help="embed tags in separate processes instead of threads", action='store_true')
+    parser.add_argument("--order", dest="order", help="download the smallest or largest files first, instead of in the given order", type=str, choices=["input", "small_first", "large_first"], default="input")
+    parser.add_argument("--max_large", dest="max_large", help="how many large files to download at once", type=int, default=None, metavar="TRANSFERS")
+    parser.add_argument("--large_size", dest="large_size", help="the size in bytes from which a file counts as large", type=int, default=__default_large_file_size__, metavar="BYTES")
+    parser.add_argument("--bandwidth", dest="bandwidth", help="max download speed in bytes per second", type=float, default=None, metavar="BYTES_PER_SEC")
+    parser.add_argument("--byte_budget", dest="byte_budget", help="stop starting downloads once this many bytes have been downloaded", type=int, default=None, metavar="BYTES")
     parser.add_argument("-f", "--dl_folder", dest="dl_folder", help="the folder to download to", type=dir_path, default=".", metavar="FOLDER")
-    parser.add_argument("-n", "--name_pattern", dest="name_pattern", help="the file name (no extention), Replacements: {m}=md5, {i}=post_id ", type=str, default=__default_name_pattern__, metavar="NAME")
+    parser.add_argument("-n", "--name_pattern", dest="name_pattern", help="the file name (no extention), Replacements: {m}=md5, {i}=post_id, {v}=variant ", type=str, default=__default_name_pattern__, metavar="NAME")
+    parser.add_argument("--variant", dest="variant", help="download the original file, or the smaller sample or preview image", type=str, choices=list(__variants__), default="file")
     parser.add_argument("-t", "--no_tags", dest="add_tags", help="don't embedd tags or metadata", action='store_false')
     parser.add_argument("-j", "--save_json", dest="save_json", help="saves metadata in a seperate .json file in additon to other options", action='store_true')
+    parser.add_argument("--json_shards", dest="json_shards", help="appends metadata to JSON-lines shards in this folder instead of one file per post", type=str, default=None, metavar="SHARDS_FOLDER")
+    parser.add_argument("--json_compression", dest="json_compression", help="compression for the --json_shards files", type=str, choices=["none", "gzip", "zstd"], default="none")
+    parser.add_argument("-s", "--skip_existing", dest="skip_existing", help="don't download images that are already saved with a matching MD5", action='store_true')
+    parser.add_argument("--journal", dest="journal", help="a file to record the progress of a bulk download in", type=str, default=None, metavar="JOURNAL_FILE")
+    parser.add_argument("-r", "--resume", dest="resume", help="skip posts the journal already has as complete", action='store_true')
+    parser.add_argument("--index", dest="index", help="a tag index file to add downloaded posts to, for offline --query searches", type=str, default=None, metavar="INDEX_FILE")
+    parser.add_argument("--query", dest="query", help="search the --index for posts matching tags (-tag to exclude, ~tag for any of), without downloading anything", type=str, default=None, metavar="QUERY")
+    parser.add_argument("--store", dest="store", help="a content store folder, so each unique image is only downloaded and stored once", type=str, default=None, metavar="STORE_FOLDER")
+    parser.add_argument("--metrics", dest="metrics", help="a file to write download timings and counters to", type=str, default=None, metavar="METRICS_FILE")
+    parser.add_argument("--metrics_format", dest="metrics_format", help="'jsonl' for one line per post, or 'prometheus' for aggregate counters and histograms", type=str, choices=["jsonl", "prometheus"], default="jsonl")
+    parser.add_argument("-c", "--cache", dest="cache", help="a file to cache post metadata in between runs", type=str, default=None, metavar="CACHE_FILE")
+    parser.add_argument("--cache_ttl", dest="cache_ttl", help="how many seconds cached metadata stays valid", type=float, default=__default_cache_ttl__, metavar="SECONDS")
+    parser.add_argument("--api_rate", dest="api_rate", help="max API requests per second", type=float, default=__default_api_rate_limit__, metavar="RATE")
+    parser.add_argument("--retries", dest="retries", help="how many times to try each request before giving up", type=int, default=__default_max_attempts__, metavar="ATTEMPTS")
     parser.add_argument("-a", "--authorization", dest="authorization", help="your e621 username and API key", type=str, default=None, metavar="USERNAME:API_KEY")
+    parser.add_argument("--base_url", dest="base_url", help="manual override of the e621 site URL", type=str, default=__e621_base_url__, metavar="URL")
     parser.add_argument("-u", "--user_agent", dest="user_agent", help="manual override of the user agent string", type=str, default=__default_user_agent__, metavar="USERAGENT")
-    parser.add_argument("-m", "--memory_limit_ratio", dest="memory_limit_ratio", help="max percentage of available memory to use", type=float, default=__default_memory_limit_ratio__, metavar="MEM_LIMIT")
+    parser.add_argument("-m", "--memory_limit_ratio", dest="memory_limit_ratio", help="max share of available memory for all tag embedding together", type=float, default=__default_memory_limit_ratio__, metavar="MEM_LIMIT")
     
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    
+    if args.workers < 1:
+        parser.error("the number of workers must be greater than 0")
+    if args.resume and args.journal == None:
+        parser.error("--resume needs a --journal file")
+    if args.query != None and args.index == None:
+        parser.error("--query needs an --index file")
+    if args.sync != None and args.tags == None:
+        parser.error("--sync needs a --tags query")
+    if args.coordinate != None and args.tags == None:
+        parser.error("--coordinate needs a --tags query")
+    if args.coordinate != None and args.sync != None:
+        parser.error("--coordinate and --sync can't be used together")
+    if args.shard_size < 1:
+        parser.error("the shard size must be greater than 0")
+    if args.lease_time <= 0:
+        parser.error("the lease time must be greater than 0")
+    if args.recheck < 0:
+        parser.error("the number of posts to recheck must be a positive integer")
+    if args.tag_workers != None and args.tag_workers < 1:
+        parser.error("the number of tag workers must be greater than 0")
+    if args.api_rate <= 0:
+        parser.error("the API rate must be greater than 0")
+    if args.retries < 1:
+        parser.error("the number of attempts must be greater than 0")
+    if args.max_large != None and args.max_large < 1:
+        parser.error("the number of large transfers must be greater than 0")
+    if args.bandwidth != None and args.bandwidth <= 0:
+        parser.error("the bandwidth must be greater than 0")
+    if args.memory_limit_ratio <= 0 or args.memory_limit_ratio > 1:
+        parser.error("the memory limit must be greater than 0 and at most 1")
+    
+    return args
+
+def read_post_ids(f):
+    post_ids = list()
+    for line in f:
+        line = line.split("#")[0].strip()
+        if len(line) > 0:
+            post_ids.append(int(line))
+    return post_ids
+
+def get_post_ids(args):
+    post_ids = list(args.post_ids)
+    
+    if args.ids_file == "-":
+        post_ids += read_post_ids(sys.stdin)
+    elif args.ids_file != None:
+        with open(args.ids_file, "r") as f:
+            post_ids += read_post_ids(f)
+    elif len(post_ids) == 0 and not sys.stdin.isatty():
+        post_ids += read_post_ids(sys.stdin)
+    
+    return post_ids
+
+def get_results_status(results):
+    if results["skipped_image"]:
+        return "{} (already downloaded)".format(results["path_image"])
+    if results["saved_image"]:
+        return results["path_image"]
+    if results["error"] != "":
+        return "ERROR: {}".format(results["error"])
+    if not results["post_exists"]:
+        return "ERROR: No info returned."
+    if results["post_deleted"]:
+        return "ERROR: Image has been deleted."
+    return "ERROR: Image has no download URL."
+
+def print_bulk_results(results, total=None):
+    downloaded = 0
+    count = 0
+    for r in results:
+        count += 1
+        if r["saved_image"]:
+            downloaded += 1
+        if total != None:
+            print("[{}/{}] Post {}: {}".format(count, total, r["post_id"], get_results_status(r)))
+        else:
+            print("[{}] Post {}: {}".format(count, r["post_id"], get_results_status(r)))
+    
+    print("Done! Downloaded {} of {} posts.".format(downloaded, count))
 
 def main(args):
     args = parse_args(args)
     
-    r = download_image(post_id=args.post_id, output_folder=args.dl_folder, name_pattern=args.name_pattern, add_tags=args.add_tags, save_json=args.save_json, auth=args.authorization, user_agent=args.user_agent, use_messages=True, use_warnings=False, memory_limit_ratio=args.memory_limit_ratio)
+    # Queries are answered from the local index alone
+    if args.query != None:
+        query_index(args.index, args.query)
+        return
+    
+    cache = None
+    if args.cache != None:
+        cache = PostCache(args.cache, ttl=args.cache_ttl)
+    
+    metrics = None
+    if args.metrics != None and args.metrics_format == "prometheus":
+        metrics = Metrics(args.metrics)
+    elif args.metrics != None:
+        metrics = JsonLinesSink(args.metrics)
+    
+    hooks = list()
+    if metrics != None:
+        hooks.append(metrics)
+    set_default_client(Client(base_url=args.base_url, cache=cache, api_rate_limit=args.api_rate, retry_policy=RetryPolicy(max_attempts=args.retries), hooks=hooks))
+    
+    metadata_sink = None
+    if args.json_shards != None:
+        metadata_sink = MetadataShards(args.json_shards, compression=None if args.json_compression == "none" else args.json_compression)
+    
+    tag_index = None
+    if args.index != None:
+        tag_index = TagIndex(args.index)
+    
+    journal = None
+    if args.journal != None:
+        journal = Journal(args.journal, flush_first=[sink for sink in (metadata_sink, tag_index) if sink != None])
+    
+    # Make sure buffered journal entries, metrics, metadata and index entries are written even if the run is interrupted
+    try:
+        download_from_args(args, journal, metadata_sink=metadata_sink, tag_index=tag_index)
+    finally:
+        if journal != None:
+            journal.close()
+        if tag_index != None:
+            tag_index.close()
+        if metrics != None:
+            metrics.close()
+        if metadata_sink != None:
+            metadata_sink.close()
+
+def query_index(index_path, query):
+    if not os.path.isfile(index_path):
+        print("ERROR: No tag index at {}".format(index_path))
+        return
+    with TagIndex(index_path) as tag_index:
+        post_ids = tag_index.search(query)
+        paths = tag_index.get_paths(post_ids)
+    for post_id in post_ids:
+        print("{}\t{}".format(post_id, paths.get(post_id, "")))
+    print("Found {} posts.".format(len(post_ids)), file=sys.stderr)
+
+def download_from_args(args, journal=None, metadata_sink=None, tag_index=None):
+    bulk_args = {
+        "workers": args.workers,
+        "tag_workers": args.tag_workers,
+        "tag_processes": args.tag_processes,
+        "journal": journal,
+        "resume": args.resume
+    }
+    
+    download_args = {
+        "output_folder": args.dl_folder,
+        "name_pattern": args.name_pattern,
+        "add_tags": args.add_tags,
+        "save_json": args.save_json,
+        "auth": args.authorization,
+        "user_agent": args.user_agent,
+        "use_warnings": False,
+        "skip_existing": args.skip_existing,
+        "memory_limit_ratio": args.memory_limit_ratio,
+        "variant": args.variant
+    }
+    if args.store != None:
+        download_args["store"] = ContentStore(args.store)
+    if metadata_sink != None:
+        download_args["metadata_sink"] = metadata_sink
+    if tag_index != None:
+        download_args["tag_index"] = tag_index
+    
+    # One memory budget for every embed in the run, so -m is a real cap however many run at once
+    if args.add_tags:
+        download_args["memory_governor"] = MemoryGovernor(args.memory_limit_ratio)
+    
+    # Results are printed as they finish when a scheduler is in charge, so one big file doesn't hold up the output
+    if args.order != "input" or args.max_large != None or args.bandwidth != None or args.byte_budget != None:
+        download_args["scheduler"] = Scheduler(order=None if args.order == "input" else args.order, large_file_size=args.large_size, max_large_transfers=args.max_large, bandwidth_limit=args.bandwidth, byte_budget=args.byte_budget)
+        bulk_args["ordered"] = False
+    
+    # Coordinated mode, this process is one of many workers sharing the query by post ID range
+    if args.coordinate != None:
+        with Coordinator(args.coordinate, lease_time=args.lease_time) as coordinator:
+            # A requeued shard is downloaded again from its cursor, so files from the last attempt are always kept
+            download_args["skip_existing"] = True
+            results = iter_download_shards(args.tags, coordinator, shard_size=args.shard_size, **bulk_args, **download_args)
+            print_bulk_results(results)
+            status = coordinator.get_status(args.tags)
+            print("Shards: {} done, {} leased, {} pending.".format(status["done"], status["leased"], status["pending"]))
+        return
+    
+    # Sync mode, only posts newer than the last run (and changed recent ones) are downloaded
+    if args.sync != None:
+        with SyncState(args.sync) as state:
+            high_water = state.get_high_water(args.tags)
+            if high_water != None:
+                print("Syncing posts after {}...".format(high_water))
+            results = iter_sync(args.tags, state, recheck=args.recheck, limit=args.limit, **bulk_args, **download_args)
+            print_bulk_results(results)
+        return
+    
+    # Tag query mode, each post's JSON is passed on so it isn't fetched again
+    if args.tags != None:
+        posts = iter_posts(tags=args.tags, limit=args.limit, auth=args.authorization, user_agent=args.user_agent)
+        results = iter_download_images(posts, **bulk_args, **download_args)
+        print_bulk_results(results)
+        return
+    
+    post_ids = get_post_ids(args)
+    if len(post_ids) == 0:
+        print("No post IDs given. Use -i, --ids-file, --tags, or pipe IDs into stdin.")
+        return
+    
+    if len(post_ids) == 1 and journal == None:
+        r = download_image(post_id=post_ids[0], use_messages=True, **download_args)
+        return
+    
+    # Don't look up posts that are already done
+    if args.resume:
+        completed = journal.get_completed()
+        post_ids = [post_id for post_id in post_ids if post_id not in completed]
+        print("Resuming, {} posts left to download.".format(len(post_ids)))
+        if len(post_ids) == 0:
+            return
+    
+    # Look the posts up in batches, then pass each post's JSON on to the downloader
+    print("Getting info for {} posts...".format(len(post_ids)))
+    batch = get_info_json_batch(post_ids, auth=args.authorization, user_agent=args.user_agent)
+    for post_id in batch["missing"]:
+        print("Post {}: ERROR: No info returned.".format(post_id))
+        results = make_results(post_id)
+        results["post_exists"] = False
+        run_hooks(get_default_client().hooks, results)
+        if journal != None:
+            journal.record(results)
+    
+    results = iter_download_images(batch["posts"], **bulk_args, **download_args)
+    print_bulk_results(results, total=len(batch["posts"]))
 
 def run():
     main(sys.argv[1:])
@@ -0,0 +1,213 @@
+import array
+import bisect
+import collections
+import threading
+
+from .lazy import lazy_import
+
+sqlite3 = lazy_import("sqlite3")
+
+__default_index_flush_every__ = 1000 # posts
+__index_all_posts__ = "" # Every post is listed under the empty tag, so queries that only exclude tags have something to start from
+
+def decode_post_ids(data):
+    post_ids = array.array("I")
+    post_ids.frombytes(data)
+    return post_ids
+
+def merge_post_ids(post_ids, added, removed):
+    # New posts almost always have higher IDs than everything indexed so far, so they can just be appended
+    added = sorted(added)
+    if len(removed) == 0 and (len(post_ids) == 0 or (len(added) > 0 and added[0] > post_ids[-1])):
+        post_ids.extend(added)
+        return post_ids
+    merged = set(post_ids)
+    merged.update(added)
+    merged.difference_update(removed)
+    return array.array("I", sorted(merged))
+
+def intersect_post_ids(post_ids, other):
+    # Binary search the bigger sorted list when one side is much smaller, instead of hashing all of it
+    if len(post_ids) * 16 < len(other):
+        found = list()
+        for post_id in post_ids:
+            i = bisect.bisect_left(other, post_id)
+            if i < len(other) and other[i] == post_id:
+                found.append(post_id)
+        return found
+    return sorted(set(post_ids).intersection(other))
+
+def parse_query(query):
+    # e621 search syntax, plain tags must all match, ~tags are OR'ed together and -tags are excluded
+    all_tags = list()
+    any_tags = list()
+    no_tags = list()
+    for token in query.split():
+        if token.startswith("-") and len(token) > 1:
+            no_tags.append(token[1:])
+        elif token.startswith("~") and len(token) > 1:
+            any_tags.append(token[1:])
+        else:
+            all_tags.append(token)
+    return all_tags, any_tags, no_tags
+
+class TagIndex:
+    def __init__(self, path, flush_every=__default_index_flush_every__):
+        if type(flush_every) != int or flush_every < 1:
+            raise ValueError("The 'flush_every' parameter must be an integer greater than 0")
+        
+        self.path = path
+        self.flush_every = flush_every
+        
+        # Posts are buffered and merged into the tag lists in one transaction
+        self.added = dict()
+        self.removed = set()
+        self.lock = threading.Lock()
+        
+        # Each tag maps to a sorted array of post IDs, stored as one blob
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tags (tag TEXT PRIMARY KEY, post_ids BLOB NOT NULL) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS posts (post_id INTEGER PRIMARY KEY, path TEXT NOT NULL, tags TEXT NOT NULL)")
+        self.db.commit()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def __len__(self):
+        self.flush()
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+    
+    def __contains__(self, post_id):
+        return self.get_path(post_id) != None
+    
+    def add(self, post_id, tags, path=""):
+        with self.lock:
+            self.removed.discard(post_id)
+            self.added[post_id] = (tuple(tags), path)
+            if len(self.added) + len(self.removed) >= self.flush_every:
+                self._flush()
+    
+    def add_many(self, posts):
+        # Takes (post_id, tags, path) tuples
+        for post_id, tags, path in posts:
+            self.add(post_id, tags, path=path)
+    
+    def remove(self, post_id):
+        with self.lock:
+            self.added.pop(post_id, None)
+            self.removed.add(post_id)
+            if len(self.added) + len(self.removed) >= self.flush_every:
+                self._flush()
+    
+    def _get_indexed_tags(self, post_ids):
+        post_ids = list(post_ids)
+        indexed = dict()
+        # Stay under SQLite's limit on query parameters
+        for i in range(0, len(post_ids), 500):
+            chunk = post_ids[i:i + 500]
+            for post_id, tags in self.db.execute("SELECT post_id, tags FROM posts WHERE post_id IN ({})".format(",".join("?" * len(chunk))), chunk):
+                indexed[post_id] = set(tags.split("\n"))
+        return indexed
+    
+    def _flush(self):
+        if len(self.added) == 0 and len(self.removed) == 0:
+            return
+        
+        # Work out which tag lists each post joins or leaves, compared to what is already indexed
+        indexed = self._get_indexed_tags(list(self.added) + list(self.removed))
+        tag_added = collections.defaultdict(list)
+        tag_removed = collections.defaultdict(set)
+        for post_id, (tags, path) in self.added.items():
+            old_tags = indexed.get(post_id, set())
+            new_tags = set(tags)
+            new_tags.add(__index_all_posts__)
+            for tag in new_tags.difference(old_tags):
+                tag_added[tag].append(post_id)
+            for tag in old_tags.difference(new_tags):
+                tag_removed[tag].add(post_id)
+        for post_id in self.removed:
+            for tag in indexed.get(post_id, set()):
+                tag_removed[tag].add(post_id)
+        
+        for tag in set(tag_added).union(tag_removed):
+            row = self.db.execute("SELECT post_ids FROM tags WHERE tag = ?", (tag,)).fetchone()
+            post_ids = merge_post_ids(decode_post_ids(row[0]) if row != None else array.array("I"), tag_added.get(tag, ()), tag_removed.get(tag, set()))
+            if len(post_ids) == 0:
+                self.db.execute("DELETE FROM tags WHERE tag = ?", (tag,))
+            else:
+                self.db.execute("INSERT OR REPLACE INTO tags (tag, post_ids) VALUES (?, ?)", (tag, post_ids.tobytes()))
+        
+        rows = [(post_id, path, "\n".join([__index_all_posts__] + [tag for tag in tags if tag != __index_all_posts__])) for post_id, (tags, path) in self.added.items()]
+        self.db.executemany("INSERT OR REPLACE INTO posts (post_id, path, tags) VALUES (?, ?, ?)", rows)
+        self.db.executemany("DELETE FROM posts WHERE post_id = ?", [(post_id,) for post_id in self.removed])
+        self.db.commit()
+        self.added = dict()
+        self.removed = set()
+    
+    def flush(self):
+        with self.lock:
+            self._flush()
+    
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
+    
+    def get_post_ids(self, tag):
+        self.flush()
+        with self.lock:
+            row = self.db.execute("SELECT post_ids FROM tags WHERE tag = ?", (tag,)).fetchone()
+            
+            # Allow e621 style "rating:s" for the "rating: s" tags get_tags_from_json makes
+            if row == None and ":" in tag and ": " not in tag:
+                row = self.db.execute("SELECT post_ids FROM tags WHERE tag = ?", (tag.replace(":", ": ", 1),)).fetchone()
+        if row == None:
+            return array.array("I")
+        return decode_post_ids(row[0])
+    
+    def query(self, all_tags=(), any_tags=(), no_tags=()):
+        # Start from the smallest list, so every step after it has as little as possible to check
+        include = sorted([self.get_post_ids(tag) for tag in all_tags], key=len)
+        if len(any_tags) > 0:
+            any_ids = set()
+            for tag in any_tags:
+                any_ids.update(self.get_post_ids(tag))
+            include.insert(0, array.array("I", sorted(any_ids)))
+            include.sort(key=len)
+        if len(include) == 0:
+            include.append(self.get_post_ids(__index_all_posts__))
+        
+        post_ids = include[0]
+        for other in include[1:]:
+            if len(post_ids) == 0:
+                break
+            post_ids = intersect_post_ids(post_ids, other)
+        
+        if len(no_tags) > 0 and len(post_ids) > 0:
+            excluded = set()
+            for tag in no_tags:
+                excluded.update(self.get_post_ids(tag))
+            post_ids = [post_id for post_id in post_ids if post_id not in excluded]
+        return list(post_ids)
+    
+    def search(self, query):
+        all_tags, any_tags, no_tags = parse_query(query)
+        return self.query(all_tags=all_tags, any_tags=any_tags, no_tags=no_tags)
+    
+    def get_path(self, post_id):
+        return self.get_paths([post_id]).get(post_id)
+    
+    def get_paths(self, post_ids):
+        self.flush()
+        post_ids = list(post_ids)
+        paths = dict()
+        with self.lock:
+            for i in range(0, len(post_ids), 500):
+                chunk = post_ids[i:i + 500]
+                paths.update(self.db.execute("SELECT post_id, path FROM posts WHERE post_id IN ({})".format(",".join("?" * len(chunk))), chunk))
+        return paths
@@ -0,0 +1,96 @@
+import json
+import threading
+import time
+
+from .lazy import lazy_import
+
+sqlite3 = lazy_import("sqlite3")
+
+__default_journal_flush_every__ = 100 # results
+__default_journal_flush_interval__ = 5 # 5 seconds
+
+def is_complete(results, add_tags=True):
+    # Posts that can never be downloaded count as done, so a resume doesn't keep retrying them
+    if results["error"] != "":
+        return False
+    if not results["post_exists"] or results["post_deleted"]:
+        return True
+    if not results["saved_image"]:
+        return False
+    if add_tags and not results["saved_tags"] and not results["skipped_image"]:
+        return False
+    return True
+
+class Journal:
+    def __init__(self, path, flush_every=__default_journal_flush_every__, flush_interval=__default_journal_flush_interval__, flush_first=None):
+        if type(flush_every) != int or flush_every < 1:
+            raise ValueError("The 'flush_every' parameter must be an integer greater than 0")
+        
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        
+        # Buffered metadata (like MetadataShards or a TagIndex) is written before any row that says its post is done
+        self.flush_first = list(flush_first or [])
+        
+        # Results are buffered and written in one transaction, so the journal keeps up with the downloads
+        self.buffer = list()
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+        
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS journal (post_id INTEGER PRIMARY KEY, complete INTEGER NOT NULL, updated REAL NOT NULL, results TEXT NOT NULL)")
+        self.db.commit()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def record(self, results, add_tags=True):
+        if type(results["post_id"]) != int:
+            return
+        
+        row = (results["post_id"], int(is_complete(results, add_tags=add_tags)), time.time(), json.dumps(results, separators=(",", ":")))
+        with self.lock:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.flush_every or time.monotonic() - self.flushed >= self.flush_interval:
+                self._flush()
+    
+    def _flush(self):
+        if len(self.buffer) > 0:
+            for sink in self.flush_first:
+                sink.flush()
+            self.db.executemany("INSERT OR REPLACE INTO journal (post_id, complete, updated, results) VALUES (?, ?, ?, ?)", self.buffer)
+            self.db.commit()
+            self.buffer = list()
+        self.flushed = time.monotonic()
+    
+    def flush(self):
+        with self.lock:
+            self._flush()
+    
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
+    
+    def get_completed(self):
+        self.flush()
+        with self.lock:
+            return set(row[0] for row in self.db.execute("SELECT post_id FROM journal WHERE complete = 1"))
+    
+    def get_failed(self):
+        self.flush()
+        with self.lock:
+            return set(row[0] for row in self.db.execute("SELECT post_id FROM journal WHERE complete = 0"))
+    
+    def get(self, post_id):
+        self.flush()
+        with self.lock:
+            row = self.db.execute("SELECT results FROM journal WHERE post_id = ?", (post_id,)).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
@@ -0,0 +1,27 @@
+import importlib
+import importlib.util
+
+class LazyModule:
+    # Stands in for a module until one of its attributes is used, then imports it for real
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def _load(self):
+        # The import system's own locks make this safe when several threads get here at once
+        if self._module == None:
+            importlib.import_module(self._name)
+            self._module = importlib.import_module(self._name.split(".")[0])
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+    
+    def __repr__(self):
+        return "<lazy module '{}'>".format(self._name)
+
+def lazy_import(name):
+    # Like "import name", so "a.b" gives back a stand-in for "a" that has "b" loaded
+    if importlib.util.find_spec(name) == None:
+        raise ImportError("No module named '{}'".format(name), name=name)
+    return LazyModule(name)
@@ -0,0 +1,129 @@
+import collections
+import contextlib
+import itertools
+import os
+import threading
+
+from .lazy import lazy_import
+
+try:
+    psutil = lazy_import("psutil")
+except ImportError:
+    psutil = None
+
+try:
+    resource = lazy_import("resource")
+except ImportError:
+    resource = None
+
+__default_memory_limit_ratio__ = 0.8 # imgtag.__DEFAULT_MEMORY_LIMIT_RATIO__, without importing imgtag
+__default_embed_memory_overhead__ = 1024 * 1024 * 16 # 16 MiB for Exempi and the interpreter
+__embed_memory_per_file_byte__ = 2 # The file is read in, and written back out
+__embed_memory_per_pixel__ = 4 # In case a handler decodes the image, RGBA
+__governed_memory_limit_ratio__ = 1 # imgtag only ever lowers RLIMIT_AS to this share of available memory, so a process-wide limit stays in place
+
+# The process-wide address space limit set by set_memory_limit(), if any
+_memory_limit = None
+
+def get_available_memory():
+    if psutil != None:
+        return psutil.virtual_memory().available
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+def get_address_space():
+    if psutil != None:
+        return psutil.Process().memory_info().vms
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+def set_memory_limit(budget):
+    # RLIMIT_AS covers the whole process, so the limit is what it already uses plus the budget, and never above an existing limit
+    global _memory_limit
+    if resource == None:
+        return False
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = get_address_space() + budget
+        if soft != resource.RLIM_INFINITY:
+            limit = min(limit, soft)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    except (OSError, ValueError):
+        return False
+    _memory_limit = limit
+    return True
+
+def get_memory_limit():
+    return _memory_limit
+
+def restore_memory_limit():
+    # imgtag lifts RLIMIT_AS altogether whenever it closes a file, so the process-wide limit is put back after every embed
+    if _memory_limit == None or resource == None:
+        return False
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (_memory_limit, hard))
+    except (OSError, ValueError):
+        return False
+    return True
+
+def estimate_embed_memory(image_path, image_info, variant="file"):
+    # The file on disk is what gets embedded into, which may be a sample or preview rather than the original
+    if os.path.isfile(image_path):
+        size = os.path.getsize(image_path)
+    else:
+        size = image_info["file"]["size"] or 0
+    dimensions = image_info.get(variant) or image_info["file"]
+    pixels = (dimensions.get("width") or 0) * (dimensions.get("height") or 0)
+    return __default_embed_memory_overhead__ + size * __embed_memory_per_file_byte__ + pixels * __embed_memory_per_pixel__
+
+class MemoryGovernor:
+    def __init__(self, memory_limit_ratio=__default_memory_limit_ratio__, budget=None, limit_process=False):
+        if type(memory_limit_ratio) not in [float, int] or memory_limit_ratio <= 0 or memory_limit_ratio > 1:
+            raise ValueError("The 'memory_limit_ratio' parameter must be a float greater than 0 and less than or equal to 1")
+        if budget != None and (type(budget) != int or budget < 1):
+            raise ValueError("The 'budget' parameter must be a number of bytes greater than 0, or None to use memory_limit_ratio")
+        
+        # The budget is a share of the memory that was available when the job started, for every embed at once
+        if budget == None:
+            budget = int(get_available_memory() * memory_limit_ratio)
+        self.budget = budget
+        self.used = 0
+        
+        # Optionally, one address space limit for the whole process as well, which also applies to everything else it does
+        self.limit_process = limit_process
+        if limit_process:
+            set_memory_limit(budget)
+        self.peak = 0
+        
+        # Jobs are admitted strictly in the order they asked, so a big image can't be starved by small ones
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        self.tickets = itertools.count()
+    
+    def acquire(self, amount):
+        with self.condition:
+            ticket = next(self.tickets)
+            self.queue.append(ticket)
+            
+            # A job bigger than the whole budget still runs, but only on its own
+            while self.queue[0] != ticket or (self.used > 0 and self.used + amount > self.budget):
+                self.condition.wait()
+            self.queue.popleft()
+            self.used += amount
+            self.peak = max(self.peak, self.used)
+            self.condition.notify_all()
+    
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+    
+    @contextlib.contextmanager
+    def reserve(self, amount):
+        self.acquire(amount)
+        try:
+            yield
+        finally:
+            self.release(amount)
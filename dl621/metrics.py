@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+
+__default_metrics_buckets__ = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+__default_metrics_write_interval__ = 15 # 15 seconds
+__metrics_outcomes__ = ("saved", "skipped", "error", "missing", "deleted", "no_url")
+
+def add_timing(results, stage, seconds, size=None):
+    # Stages that run more than once for a post (like retried transfers) add up
+    if results == None:
+        return
+    results["timings"][stage] = results["timings"].get(stage, 0.0) + seconds
+    if size != None:
+        results["bytes"][stage] = results["bytes"].get(stage, 0) + size
+
+def timed_call(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def get_outcome(results):
+    if results["skipped_image"]:
+        return "skipped"
+    if results["saved_image"]:
+        return "saved"
+    if results["error"] != "":
+        return "error"
+    if not results["post_exists"]:
+        return "missing"
+    if results["post_deleted"]:
+        return "deleted"
+    return "no_url"
+
+class Metrics:
+    def __init__(self, path=None, buckets=__default_metrics_buckets__, write_interval=__default_metrics_write_interval__):
+        self.path = path
+        self.buckets = tuple(sorted(buckets))
+        self.write_interval = write_interval
+        self.written = time.monotonic()
+        self.lock = threading.Lock()
+        
+        self.outcomes = dict((outcome, 0) for outcome in __metrics_outcomes__)
+        self.stages = dict()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def __call__(self, results):
+        self.record(results)
+    
+    def _get_stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {"count": 0, "seconds": 0.0, "bytes": 0, "buckets": [0] * len(self.buckets)}
+        return self.stages[stage]
+    
+    def record(self, results):
+        with self.lock:
+            self.outcomes[get_outcome(results)] += 1
+            for stage, seconds in results["timings"].items():
+                totals = self._get_stage(stage)
+                totals["count"] += 1
+                totals["seconds"] += seconds
+                for i, bucket in enumerate(self.buckets):
+                    if seconds <= bucket:
+                        totals["buckets"][i] += 1
+            for stage, size in results["bytes"].items():
+                self._get_stage(stage)["bytes"] += size
+            
+            # Rewrite the file every so often, so long jobs can be scraped while they run
+            write = self.path != None and time.monotonic() - self.written >= self.write_interval
+            if write:
+                self.written = time.monotonic()
+        if write:
+            self.write_prometheus()
+    
+    def to_prometheus(self):
+        with self.lock:
+            lines = list()
+            lines.append("# HELP dl621_posts_total Posts processed, by outcome.")
+            lines.append("# TYPE dl621_posts_total counter")
+            for outcome, count in self.outcomes.items():
+                lines.append('dl621_posts_total{{outcome="{}"}} {}'.format(outcome, count))
+            
+            lines.append("# HELP dl621_stage_seconds Time spent in each stage of a download.")
+            lines.append("# TYPE dl621_stage_seconds histogram")
+            for stage, totals in self.stages.items():
+                for bucket, count in zip(self.buckets, totals["buckets"]):
+                    lines.append('dl621_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bucket, count))
+                lines.append('dl621_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage, totals["count"]))
+                lines.append('dl621_stage_seconds_sum{{stage="{}"}} {}'.format(stage, totals["seconds"]))
+                lines.append('dl621_stage_seconds_count{{stage="{}"}} {}'.format(stage, totals["count"]))
+            
+            lines.append("# HELP dl621_stage_bytes_total Bytes moved in each stage of a download.")
+            lines.append("# TYPE dl621_stage_bytes_total counter")
+            for stage, totals in self.stages.items():
+                if totals["bytes"] > 0:
+                    lines.append('dl621_stage_bytes_total{{stage="{}"}} {}'.format(stage, totals["bytes"]))
+            return "\n".join(lines) + "\n"
+    
+    def write_prometheus(self, path=None):
+        if path == None:
+            path = self.path
+        
+        # Write to a temporary file first, so a scraper never sees half a file
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+        self.written = time.monotonic()
+    
+    def close(self):
+        if self.path != None:
+            self.write_prometheus()
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def __call__(self, results):
+        self.record(results)
+    
+    def record(self, results):
+        line = json.dumps(dict(results, time=time.time()), separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
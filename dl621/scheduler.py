@@ -0,0 +1,122 @@
+import contextlib
+import heapq
+import itertools
+import threading
+
+from .throttle import RateLimiter
+
+__default_scheduler_lookahead__ = 1000 # posts
+__default_large_file_size__ = 1024 * 1024 * 50 # 50 MiB
+__scheduler_orders__ = (None, "small_first", "large_first")
+
+class ByteBudgetError(IOError):
+    pass
+
+def get_post_size(item):
+    # Post IDs haven't been looked up yet, so their size isn't known
+    if isinstance(item, dict):
+        return item["file"]["size"] or 0
+    return 0
+
+def get_received_size(results):
+    if results == None:
+        return 0
+    return results["bytes"].get("transfer", 0)
+
+def get_post_ext(item):
+    if isinstance(item, dict):
+        return item["file"]["ext"]
+    return None
+
+class Scheduler:
+    def __init__(self, order=None, ext_order=None, lookahead=__default_scheduler_lookahead__, large_file_size=__default_large_file_size__, max_large_transfers=None, bandwidth_limit=None, byte_budget=None):
+        if order not in __scheduler_orders__:
+            raise ValueError("The 'order' parameter must be None, 'small_first' or 'large_first'")
+        if type(lookahead) != int or lookahead < 1:
+            raise ValueError("The 'lookahead' parameter must be an integer greater than 0")
+        if max_large_transfers != None and (type(max_large_transfers) != int or max_large_transfers < 1):
+            raise ValueError("The 'max_large_transfers' parameter must be an integer greater than 0, or None for no limit")
+        if byte_budget != None and byte_budget < 0:
+            raise ValueError("The 'byte_budget' parameter must be a positive number of bytes, or None for no limit")
+        
+        self.order = order
+        self.ext_order = ext_order
+        self.lookahead = lookahead
+        self.large_file_size = large_file_size
+        self.max_large_transfers = max_large_transfers
+        self.byte_budget = byte_budget
+        self.bytes_reserved = 0
+        self.lock = threading.Lock()
+        
+        # Big files get their own few slots, so they can't tie up every worker at once
+        self.large_slots = None
+        if max_large_transfers != None:
+            self.large_slots = threading.BoundedSemaphore(max_large_transfers)
+        
+        # The bandwidth cap is a token bucket where every byte is a token
+        self.bandwidth_limiter = None
+        if bandwidth_limit != None:
+            self.bandwidth_limiter = RateLimiter(bandwidth_limit)
+    
+    def get_key(self, item):
+        if self.ext_order != None and get_post_ext(item) in self.ext_order:
+            ext_rank = self.ext_order.index(get_post_ext(item))
+        elif self.ext_order != None:
+            ext_rank = len(self.ext_order)
+        else:
+            ext_rank = 0
+        
+        if self.order == "small_first":
+            return (ext_rank, get_post_size(item))
+        if self.order == "large_first":
+            return (ext_rank, -get_post_size(item))
+        return (ext_rank, 0)
+    
+    def schedule(self, items):
+        if self.order == None and self.ext_order == None:
+            yield from items
+            return
+        
+        # Reorder within a sliding window, so a stream of posts never has to be read all at once
+        heap = list()
+        counter = itertools.count()
+        for item in items:
+            heapq.heappush(heap, (self.get_key(item), next(counter), item))
+            if len(heap) >= self.lookahead:
+                yield heapq.heappop(heap)[2]
+        while len(heap) > 0:
+            yield heapq.heappop(heap)[2]
+    
+    def is_large(self, item):
+        return self.max_large_transfers != None and get_post_size(item) >= self.large_file_size
+    
+    def reserve(self, size):
+        # Transfers are charged in full when they start, so running ones can't push the total over the budget
+        with self.lock:
+            if self.byte_budget != None and self.bytes_reserved + size > self.byte_budget:
+                raise ByteBudgetError("The byte budget is used up ({} of {} bytes, {} more needed)".format(self.bytes_reserved, self.byte_budget, size))
+            self.bytes_reserved += size
+    
+    def charge(self, size):
+        # Settles a reservation once the real number of bytes is known, which can be more or less than it
+        with self.lock:
+            self.bytes_reserved = max(0, self.bytes_reserved + size)
+    
+    @contextlib.contextmanager
+    def transfer(self, size, results=None):
+        self.reserve(size)
+        received = get_received_size(results)
+        
+        # Large posts normally run on their own workers (see Client.iter_download_images), so this only waits when the size wasn't known up front
+        large = self.large_slots != None and size >= self.large_file_size
+        if large:
+            self.large_slots.acquire()
+        try:
+            yield
+        finally:
+            if large:
+                self.large_slots.release()
+            
+            # Samples and previews have no size in the post, and retries can fetch more than the file, so the budget is kept to what was received
+            if results != None:
+                self.charge(get_received_size(results) - received - size)
@@ -0,0 +1,175 @@
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import time
+
+from .lazy import lazy_import
+
+sqlite3 = lazy_import("sqlite3")
+try:
+    zstandard = lazy_import("zstandard")
+except ImportError:
+    zstandard = None
+
+__default_shard_size__ = 1024 * 1024 * 256 # 256 MiB
+__default_shard_block_size__ = 1024 * 1024 # 1 MiB
+__default_shard_flush_interval__ = 5 # 5 seconds
+__shard_compressions__ = {None: "", "gzip": ".gz", "zstd": ".zst"}
+__shard_index_name__ = "index.sqlite"
+
+def compress_block(block, compression):
+    if compression == "gzip":
+        return gzip.compress(block, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(block)
+    return bytes(block)
+
+def decompress_block(data, compression):
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+def get_shard_compression(shard_name):
+    for compression, ext in __shard_compressions__.items():
+        if compression != None and shard_name.endswith(".jsonl" + ext):
+            return compression
+    return None
+
+class MetadataShards:
+    def __init__(self, folder, compression=None, shard_size=__default_shard_size__, block_size=__default_shard_block_size__, flush_interval=__default_shard_flush_interval__):
+        if compression not in __shard_compressions__:
+            raise ValueError("The 'compression' parameter must be None, 'gzip' or 'zstd'")
+        if compression == "zstd" and zstandard == None:
+            raise ImportError("zstd compression needs the 'zstandard' module (pip install dl621[zstd])")
+        
+        self.folder = folder
+        self.compression = compression
+        self.shard_size = shard_size
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        os.makedirs(folder, exist_ok=True)
+        
+        # Records are collected into blocks, and every block is compressed on its own so it can be read back alone
+        # A slow trickle of posts still gets written out every flush_interval, so little is lost if the run dies
+        self.block = bytearray()
+        self.pending = dict()
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+        
+        self.db = sqlite3.connect(os.path.join(folder, __shard_index_name__), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS records (post_id INTEGER PRIMARY KEY, shard TEXT NOT NULL, block_offset INTEGER NOT NULL, block_length INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)")
+        self.db.commit()
+        
+        # Keep appending to the newest shard with the same compression
+        shard_names = self.get_shard_names()
+        if len(shard_names) == 0:
+            self.shard_number = 1
+        else:
+            self.shard_number = int(re.match(r"^metadata_(\d+)", shard_names[-1]).group(1))
+            if get_shard_compression(shard_names[-1]) != compression:
+                self.shard_number += 1
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def __iter__(self):
+        return self.iter_posts()
+    
+    def get_shard_names(self):
+        return sorted(name for name in os.listdir(self.folder) if re.match(r"^metadata_\d+\.jsonl(\.gz|\.zst)?$", name))
+    
+    def get_shard_name(self):
+        return "metadata_{:06d}.jsonl{}".format(self.shard_number, __shard_compressions__[self.compression])
+    
+    def get_shard_path(self, shard_name=None):
+        if shard_name == None:
+            shard_name = self.get_shard_name()
+        return os.path.join(self.folder, shard_name)
+    
+    def write(self, post):
+        line = (json.dumps(post, separators=(",", ":")) + "\n").encode()
+        with self.lock:
+            self.pending[post["id"]] = (len(self.block), len(line))
+            self.block += line
+            if len(self.block) >= self.block_size or time.monotonic() - self.flushed >= self.flush_interval:
+                self._flush()
+            return self.get_shard_path()
+    
+    def _flush(self):
+        self.flushed = time.monotonic()
+        if len(self.block) == 0:
+            return
+        
+        # Start a new shard once the current one is full
+        data = compress_block(self.block, self.compression)
+        shard_path = self.get_shard_path()
+        shard_size = os.path.getsize(shard_path) if os.path.isfile(shard_path) else 0
+        if shard_size > 0 and shard_size + len(data) > self.shard_size:
+            self.shard_number += 1
+            shard_path = self.get_shard_path()
+            shard_size = 0
+        
+        with open(shard_path, "ab") as f:
+            f.write(data)
+        
+        shard_name = self.get_shard_name()
+        rows = [(post_id, shard_name, shard_size, len(data), offset, length) for post_id, (offset, length) in self.pending.items()]
+        self.db.executemany("INSERT OR REPLACE INTO records (post_id, shard, block_offset, block_length, offset, length) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+        self.block = bytearray()
+        self.pending = dict()
+    
+    def flush(self):
+        with self.lock:
+            self._flush()
+    
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.close()
+    
+    def get(self, post_id):
+        with self.lock:
+            if post_id in self.pending:
+                offset, length = self.pending[post_id]
+                return json.loads(bytes(self.block[offset:offset + length]))
+            row = self.db.execute("SELECT shard, block_offset, block_length, offset, length FROM records WHERE post_id = ?", (post_id,)).fetchone()
+        if row == None:
+            return None
+        
+        shard_name, block_offset, block_length, offset, length = row
+        with open(self.get_shard_path(shard_name), "rb") as f:
+            f.seek(block_offset)
+            block = decompress_block(f.read(block_length), get_shard_compression(shard_name))
+        return json.loads(block[offset:offset + length])
+    
+    def __contains__(self, post_id):
+        with self.lock:
+            if post_id in self.pending:
+                return True
+            return self.db.execute("SELECT 1 FROM records WHERE post_id = ?", (post_id,)).fetchone() != None
+    
+    def iter_posts(self):
+        # Every record in write order, including older copies of posts that were written again
+        self.flush()
+        for shard_name in self.get_shard_names():
+            compression = get_shard_compression(shard_name)
+            with open(self.get_shard_path(shard_name), "rb") as raw:
+                if compression == "gzip":
+                    f = gzip.GzipFile(fileobj=raw)
+                elif compression == "zstd":
+                    f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+                else:
+                    f = raw
+                with f:
+                    for line in f:
+                        yield json.loads(line)
@@ -0,0 +1,105 @@
+import contextlib
+import os
+import shutil
+import threading
+
+from .lazy import lazy_import
+
+uuid = lazy_import("uuid")
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__store_lock_stripes__ = 256
+__ficlone__ = 0x40049409 # Linux FICLONE ioctl, used for reflinks
+
+def is_same_file(f, path):
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+class ContentStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._make_locks()
+    
+    def _make_locks(self):
+        self.locks = [threading.Lock() for i in range(__store_lock_stripes__)]
+    
+    # Locks can't be pickled, so each process in a tagging pool gets its own
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["locks"]
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_locks()
+    
+    @contextlib.contextmanager
+    def lock(self, path):
+        # Threads wait on a lock in memory, other processes and nodes sharing the store on a lock file next to the object
+        with self.locks[hash(path) % len(self.locks)]:
+            if fcntl == None:
+                yield
+                return
+            
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            lock_path = path + os.path.extsep + "lock"
+            while True:
+                with open(lock_path, "ab") as f:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                    # The holder before us removes the lock file when it's done, so a lock on a removed file locks nothing
+                    if not is_same_file(f, lock_path):
+                        continue
+                    try:
+                        yield
+                    finally:
+                        os.remove(lock_path)
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    return
+    
+    def get_object_path(self, md5, ext):
+        md5 = md5.lower()
+        return os.path.join(self.root, "objects", md5[:2], md5 + os.path.extsep + ext)
+    
+    def get_tagged_path(self, md5, ext, metadata_digest):
+        md5 = md5.lower()
+        return os.path.join(self.root, "tagged", md5[:2], "{}_{}".format(md5, metadata_digest) + os.path.extsep + ext)
+    
+    def get_temp_path(self, path):
+        # Keep the extension, since embedding picks the file format from it
+        folder, name = os.path.split(path)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, "tmp_{}_{}".format(uuid.uuid4().hex, name))
+    
+    def has(self, path):
+        return os.path.isfile(path)
+    
+    def clone(self, src, dst):
+        # Try a copy-on-write reflink first, then fall back to a real copy
+        if fcntl != None:
+            try:
+                with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+                    fcntl.ioctl(f_dst.fileno(), __ficlone__, f_src.fileno())
+                return
+            except OSError:
+                pass
+        shutil.copyfile(src, dst)
+    
+    def link(self, src, dst):
+        if os.path.isfile(dst) and os.path.samefile(src, dst):
+            return
+        
+        # Link to a temporary name first, so the output path is replaced in one step
+        folder, name = os.path.split(os.path.abspath(dst))
+        temp_path = os.path.join(folder, ".{}.{}.tmp".format(name, uuid.uuid4().hex))
+        try:
+            os.link(src, temp_path)
+        except OSError:
+            self.clone(src, temp_path)
+        os.replace(temp_path, dst)
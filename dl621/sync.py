@@ -0,0 +1,58 @@
+import threading
+import time
+
+from .lazy import lazy_import
+
+sqlite3 = lazy_import("sqlite3")
+
+def get_sync_query(tags):
+    # The same tags in a different order are the same query
+    return " ".join(sorted(tags.split()))
+
+class SyncState:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, high_water INTEGER NOT NULL, updated REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS posts (post_id INTEGER PRIMARY KEY, digest TEXT NOT NULL)")
+        self.db.commit()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+    
+    def get_high_water(self, tags):
+        with self.lock:
+            row = self.db.execute("SELECT high_water FROM queries WHERE query = ?", (get_sync_query(tags),)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+    
+    def get_digests(self, post_ids):
+        post_ids = list(post_ids)
+        digests = dict()
+        with self.lock:
+            # Stay under SQLite's limit on query parameters
+            for i in range(0, len(post_ids), 500):
+                chunk = post_ids[i:i + 500]
+                rows = self.db.execute("SELECT post_id, digest FROM posts WHERE post_id IN ({})".format(",".join("?" * len(chunk))), chunk)
+                digests.update(rows)
+        return digests
+    
+    def update(self, tags, high_water=None, digests=None):
+        # The high-water mark only ever moves forward, so an interrupted run can't lose track of what was done
+        with self.lock:
+            if high_water != None:
+                self.db.execute("INSERT INTO queries (query, high_water, updated) VALUES (?, ?, ?) ON CONFLICT (query) DO UPDATE SET high_water = MAX(high_water, excluded.high_water), updated = excluded.updated", (get_sync_query(tags), high_water, time.time()))
+            if digests != None:
+                self.db.executemany("INSERT OR REPLACE INTO posts (post_id, digest) VALUES (?, ?)", digests.items())
+            self.db.commit()
@@ -0,0 +1,106 @@
+import random
+import threading
+import time
+
+from .lazy import lazy_import
+
+email = lazy_import("email.utils")
+
+__default_api_rate_limit__ = 2.0 # requests per second
+__default_file_rate_limit__ = None # unlimited
+__default_max_attempts__ = 5
+__default_backoff_base__ = 1.0 # 1 second
+__default_backoff_max__ = 60.0 # 1 minute
+__default_backoff_jitter__ = 0.5
+__default_retry_statuses__ = (429, 500, 502, 503, 504)
+
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        if type(rate) not in [int, float] or rate <= 0:
+            raise ValueError("The 'rate' parameter must be a number of requests per second greater than 0")
+        if burst == None:
+            burst = max(1, rate)
+        if type(burst) not in [int, float] or burst < 1:
+            raise ValueError("The 'burst' parameter must be a number greater than or equal to 1")
+        
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def reserve(self, tokens=1):
+        # Tokens may go negative, which queues callers up behind each other
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+    
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+    
+    def pause(self, seconds):
+        # Hold every caller back, used when the server asks us to slow down
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+class RetryPolicy:
+    def __init__(self, max_attempts=__default_max_attempts__, backoff_base=__default_backoff_base__, backoff_max=__default_backoff_max__, jitter=__default_backoff_jitter__, retry_statuses=__default_retry_statuses__):
+        if max_attempts != None and (type(max_attempts) != int or max_attempts < 1):
+            raise ValueError("The 'max_attempts' parameter must be an integer greater than 0, or None to retry forever")
+        if jitter < 0 or jitter > 1:
+            raise ValueError("The 'jitter' parameter must be between 0 and 1")
+        
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.retry_statuses = tuple(retry_statuses)
+    
+    def can_retry(self, attempt):
+        return self.max_attempts == None or attempt < self.max_attempts
+    
+    def should_retry_status(self, status_code, attempt):
+        return status_code in self.retry_statuses and self.can_retry(attempt)
+    
+    def get_delay(self, attempt, retry_after=None):
+        # The server knows best how long to wait
+        retry_after = parse_retry_after(retry_after)
+        if retry_after != None:
+            return retry_after
+        
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return delay * (1 - self.jitter * random.random())
+    
+    def back_off(self, attempt, limiter=None, status_code=None, retry_after=None):
+        # Throttling slows down every caller sharing the limiter, not just this one, so there is nothing left to sleep
+        delay = self.get_delay(attempt, retry_after=retry_after)
+        if limiter != None and (status_code == 429 or retry_after != None):
+            limiter.pause(delay)
+            return 0
+        return delay
+
+def parse_retry_after(value):
+    if value == None:
+        return None
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
@@ -21,6 +21,10 @@ setup(
     url='https://github.com/nimaid/python-dl621',
     license=license,
     install_requires=["imgtag>=1.1.6", "requests", "sockets"],
+    extras_require={
+        "async": ["aiohttp"],
+        "zstd": ["zstandard"]
+    },
     packages=find_packages(exclude=('tests', 'docs')),
     entry_points={
         'console_scripts': [
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+sys.path.insert(0, os.path.join(PACKAGE_ROOT, "benchmarks"))
+
+import dl621
+from mock_e621 import MockE621
+
+TAGS = "shard_test"
+
+
+class CoordinatorTestSuite(unittest.TestCase):
+    """Shard planning, claims and leases."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.coordinator = dl621.Coordinator(os.path.join(self.folder, "coordinator.sqlite"), lease_time=0.2)
+
+    def tearDown(self):
+        self.coordinator.close()
+        shutil.rmtree(self.folder)
+
+    def get_ranges(self):
+        return self.coordinator.db.execute("SELECT low, high FROM shards ORDER BY shard").fetchall()
+
+    def test_plan_extends(self):
+        self.assertEqual(self.coordinator.plan(TAGS, 25, shard_size=10), 3)
+        self.assertEqual(self.get_ranges(), [(1, 11), (11, 21), (21, 26)])
+        self.assertEqual(self.coordinator.plan(TAGS, 25, shard_size=10), 0)
+
+        # The newest shard stops at the newest post, and grows before new shards are added
+        self.assertEqual(self.coordinator.plan(TAGS, 45, shard_size=10), 2)
+        self.assertEqual(self.get_ranges(), [(1, 11), (11, 21), (21, 31), (31, 41), (41, 46)])
+        self.assertEqual(self.coordinator.get_status(TAGS)["pending"], 5)
+
+    def test_done_shard_opens_again_when_it_grows(self):
+        self.coordinator.plan(TAGS, 5, shard_size=10)
+        shard = self.coordinator.claim(TAGS, "a")
+        self.assertTrue(self.coordinator.complete(shard, "a"))
+        self.coordinator.plan(TAGS, 8, shard_size=10)
+
+        shard = self.coordinator.claim(TAGS, "a")
+        self.assertEqual((shard["cursor"], shard["high"], shard["attempts"]), (5, 9, 1))
+
+    def test_shard_that_grew_while_leased_goes_back_in_the_queue(self):
+        self.coordinator.plan(TAGS, 5, shard_size=10)
+        shard = self.coordinator.claim(TAGS, "a")
+        self.coordinator.plan(TAGS, 8, shard_size=10)
+        self.assertTrue(self.coordinator.complete(shard, "a"))
+        self.assertEqual(self.coordinator.claim(TAGS, "b")["cursor"], 5)
+
+    def test_claims_are_exclusive(self):
+        self.coordinator.plan(TAGS, 20, shard_size=10)
+        first = self.coordinator.claim(TAGS, "a")
+        second = self.coordinator.claim(TAGS, "b")
+        self.assertEqual((first["low"], first["high"]), (1, 11))
+        self.assertEqual((second["low"], second["high"]), (11, 21))
+        self.assertIsNone(self.coordinator.claim(TAGS, "c"))
+
+        # Only the worker holding the lease can finish it
+        self.assertFalse(self.coordinator.complete(first, "b"))
+        self.assertTrue(self.coordinator.complete(first, "a"))
+        self.assertEqual(self.coordinator.get_status(TAGS), {"pending": 0, "leased": 1, "done": 1, "failed_posts": 0})
+
+    def test_expired_lease_is_requeued_with_cursor(self):
+        self.coordinator.plan(TAGS, 10, shard_size=10)
+        shard = self.coordinator.claim(TAGS, "a")
+        self.assertTrue(self.coordinator.renew(shard, "a", cursor=4))
+
+        # The worker stops renewing, as if it died
+        time.sleep(0.3)
+        requeued = self.coordinator.claim(TAGS, "b")
+        self.assertEqual(requeued["shard"], shard["shard"])
+        self.assertEqual(requeued["cursor"], 4)
+        self.assertEqual(requeued["attempts"], 2)
+        self.assertFalse(self.coordinator.renew(shard, "a"))
+
+    def test_released_shard_resumes_from_cursor(self):
+        self.coordinator.plan(TAGS, 10, shard_size=10)
+        shard = self.coordinator.claim(TAGS, "a")
+        self.assertTrue(self.coordinator.release(shard, "a", cursor=7))
+        self.assertEqual(self.coordinator.claim(TAGS, "b")["cursor"], 7)
+
+    def test_lease_renews_in_background(self):
+        self.coordinator.plan(TAGS, 10, shard_size=10)
+        shard = self.coordinator.claim(TAGS, "a")
+        with self.coordinator.lease(shard, "a") as lease:
+            lease.cursor = 5
+            time.sleep(0.5)
+            self.assertIsNone(self.coordinator.claim(TAGS, "b"))
+            self.assertFalse(lease.lost.is_set())
+
+        # The last renewal saved the cursor
+        time.sleep(0.3)
+        self.assertEqual(self.coordinator.claim(TAGS, "b")["cursor"], 5)
+
+
+class ShardDownloadTestSuite(unittest.TestCase):
+    """Coordinated downloads against the mock server."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=30, file_size=1024).start()
+        self.folder = tempfile.mkdtemp()
+        self.coordinator = dl621.Coordinator(os.path.join(self.folder, "coordinator.sqlite"), lease_time=5)
+
+    def tearDown(self):
+        self.coordinator.close()
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def download(self, worker_id):
+        client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None)
+        return client.download_shards(TAGS, self.coordinator, shard_size=10, worker_id=worker_id, output_folder=self.folder, add_tags=False, workers=2)
+
+    def test_every_post_once(self):
+        results = self.download("a")
+        self.assertEqual(sorted(r["post_id"] for r in results), list(range(1, 31)))
+        self.assertEqual(self.coordinator.get_status(TAGS)["done"], 3)
+        self.assertEqual(self.download("b"), [])
+
+    def test_new_posts_are_crawled_later(self):
+        hidden = dict((post_id, self.mock.posts.pop(post_id)) for post_id in range(26, 31))
+        results = self.download("a")
+        self.assertEqual(sorted(r["post_id"] for r in results), list(range(1, 26)))
+
+        # Posts added after the first crawl fill the rest of the newest shard
+        self.mock.posts.update(hidden)
+        results = self.download("b")
+        self.assertEqual(sorted(r["post_id"] for r in results), list(range(26, 31)))
+        self.assertEqual(self.coordinator.get_status(TAGS), {"pending": 0, "leased": 0, "done": 3, "failed_posts": 0})
+
+    def test_abandoned_shard_is_finished_by_another_worker(self):
+        self.coordinator.plan(TAGS, 30, shard_size=10)
+        self.coordinator.lease_time = 0.1
+        shard = self.coordinator.claim(TAGS, "dead")
+        self.assertTrue(self.coordinator.renew(shard, "dead", cursor=5))
+        time.sleep(0.2)
+        self.coordinator.lease_time = 5
+
+        # Only posts after the dead worker's cursor are left in its shard
+        results = self.download("b")
+        self.assertEqual(sorted(r["post_id"] for r in results), list(range(6, 31)))
+        self.assertEqual(self.coordinator.get_status(TAGS), {"pending": 0, "leased": 0, "done": 3, "failed_posts": 0})
+
+    def test_failed_post_goes_back_in_the_queue(self):
+        missing = self.mock.posts[14]["file"]["md5"]
+        data = self.mock.files.pop(missing)
+        client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None)
+
+        results = list()
+        for r in client.iter_download_shards(TAGS, self.coordinator, shard_size=10, worker_id="a", output_folder=self.folder, add_tags=False, workers=2):
+            results.append(r)
+            if r["error"] != "":
+                self.mock.files[missing] = data
+
+        # The shard is picked up again after the others, starting from the post that failed
+        post_ids = [r["post_id"] for r in results]
+        self.assertEqual(post_ids[post_ids.index(30) + 1:], list(range(14, 21)))
+        self.assertEqual([r["post_id"] for r in results if r["error"] != ""], [14])
+        self.assertEqual(self.coordinator.get_status(TAGS), {"pending": 0, "leased": 0, "done": 3, "failed_posts": 0})
+
+    def test_shard_out_of_attempts_counts_failures(self):
+        self.mock.files.pop(self.mock.posts[14]["file"]["md5"])
+        results = self.download("a")
+        self.assertEqual([r["post_id"] for r in results if r["error"] != ""], [14] * self.coordinator.max_attempts)
+        self.assertEqual(self.coordinator.get_status(TAGS), {"pending": 0, "leased": 0, "done": 3, "failed_posts": 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+sys.path.insert(0, os.path.join(PACKAGE_ROOT, "benchmarks"))
+
+import dl621
+from dl621.core import mark_verified
+from mock_e621 import MockE621, MockHandler, make_png
+
+
+class RetryTestSuite(unittest.TestCase):
+    """File download retries."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=5, file_size=1024).start()
+        self.client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None, retry_policy=dl621.RetryPolicy(max_attempts=3, backoff_base=0))
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def test_server_errors_are_retried_max_attempts_times(self):
+        post = self.mock.get_post(1)
+        self.mock.error_rate = 1.0
+        results = self.client.download_image(1, custom_json=post, output_folder=self.folder, add_tags=False)
+        self.assertIn("503", results["error"])
+        self.assertEqual(self.mock.stats["file_requests"], 3)
+
+    def test_file_comes_through_after_an_error(self):
+        failures = [True]
+        self.mock.should_fail = lambda: len(failures) > 0 and failures.pop()
+        results = self.client.download_image(1, custom_json=self.mock.get_post(1), output_folder=self.folder, add_tags=False)
+        self.assertTrue(results["saved_image"])
+        self.assertEqual(self.mock.stats["file_requests"], 2)
+
+
+class ResumeTestSuite(unittest.TestCase):
+    """Partial files and range requests."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=5, file_size=4096, file_size_jitter=0).start()
+        self.client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None, retry_policy=dl621.RetryPolicy(max_attempts=3, backoff_base=0))
+        self.folder = tempfile.mkdtemp()
+        self.post = self.mock.get_post(1)
+        self.data = self.mock.files[self.post["file"]["md5"]]
+        self.path = os.path.join(self.folder, "1.png")
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def download(self, **kwargs):
+        return self.client.download_image(1, custom_json=self.post, output_folder=self.folder, name_pattern="{i}", add_tags=False, **kwargs)
+
+    def write_part(self, data):
+        with open(self.path + ".part", "wb") as f:
+            f.write(data)
+
+    def read_image(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_part_file_is_resumed(self):
+        self.write_part(self.data[:1000])
+        results = self.download()
+        self.assertTrue(results["saved_image"])
+        self.assertEqual(self.read_image(), self.data)
+        self.assertEqual(self.mock.stats["file_bytes"], len(self.data) - 1000)
+        self.assertEqual(results["bytes"]["transfer"], len(self.data) - 1000)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+    def test_complete_part_file_is_finished(self):
+        # The server answers 416 when the partial file already has every byte
+        self.write_part(self.data)
+        results = self.download()
+        self.assertTrue(results["saved_image"])
+        self.assertEqual(self.read_image(), self.data)
+        self.assertEqual(self.mock.stats["file_bytes"], 0)
+
+    def test_server_ignoring_range_starts_over(self):
+        self.mock.ranges = False
+        self.write_part(self.data[:1000])
+        results = self.download()
+        self.assertTrue(results["saved_image"])
+        self.assertEqual(self.read_image(), self.data)
+        self.assertEqual(self.mock.stats["file_bytes"], len(self.data))
+
+    def test_corrupt_part_file_is_thrown_away(self):
+        self.write_part(b"\0" * 1000)
+        results = self.download()
+        self.assertTrue(results["saved_image"])
+        self.assertEqual(self.read_image(), self.data)
+        self.assertEqual(self.mock.stats["file_requests"], 2)
+
+    def test_cut_off_transfer_is_resumed(self):
+        # The first response ends halfway, the retry only asks for the chunks that didn't arrive
+        send_throttled = MockHandler.send_throttled
+        cut = list()
+
+        def send_cut_off(handler, body, start):
+            if len(cut) == 0:
+                cut.append(len(body))
+                body = body[:len(body) // 2]
+                handler.close_connection = True
+            send_throttled(handler, body, start)
+
+        with mock.patch.object(MockHandler, "send_throttled", send_cut_off):
+            results = self.download(chunk_size=512)
+        self.assertTrue(results["saved_image"])
+        self.assertEqual(self.read_image(), self.data)
+        self.assertEqual(self.mock.stats["file_requests"], 2)
+        self.assertEqual(self.mock.stats["file_bytes"], len(self.data))
+
+
+class VerifyTestSuite(unittest.TestCase):
+    """MD5 checks and verified stamps."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=5, file_size=1024).start()
+        self.client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None, retry_policy=dl621.RetryPolicy(max_attempts=3, backoff_base=0))
+        self.folder = tempfile.mkdtemp()
+        self.post = self.mock.get_post(1)
+        self.path = os.path.join(self.folder, "1.png")
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def download(self, **kwargs):
+        return self.client.download_image(1, custom_json=self.post, output_folder=self.folder, name_pattern="{i}", add_tags=False, **kwargs)
+
+    def test_md5_mismatch(self):
+        md5 = self.post["file"]["md5"]
+        self.mock.files[md5] = self.mock.files[md5][::-1]
+        results = self.download()
+        self.assertIn("MD5MismatchError", results["error"])
+        self.assertEqual(self.mock.stats["file_requests"], 3)
+        self.assertEqual(os.listdir(self.folder), [])
+
+        # Without a check, the same file is saved as it is
+        self.assertTrue(self.download(verify_md5=False)["saved_image"])
+
+    def check_skip_existing(self):
+        self.assertTrue(self.download()["saved_image"])
+        results = self.download(skip_existing=True)
+        self.assertTrue(results["skipped_image"])
+        self.assertEqual(self.mock.stats["file_requests"], 1)
+
+        # A file changed after it was verified, like by embedding tags, is trusted while its stamp matches
+        with open(self.path, "ab") as f:
+            f.write(b"embedded tags")
+        mark_verified(self.path, self.post["file"]["md5"])
+        self.assertTrue(self.download(skip_existing=True)["skipped_image"])
+        self.assertEqual(self.mock.stats["file_requests"], 1)
+
+        # Once the file changes again, it has to match the MD5 again
+        with open(self.path, "ab") as f:
+            f.write(b"edited")
+        self.assertFalse(self.download(skip_existing=True)["skipped_image"])
+        self.assertEqual(self.mock.stats["file_requests"], 2)
+
+    def test_skip_existing_with_xattr(self):
+        self.check_skip_existing()
+        self.assertFalse(os.path.exists(os.path.join(self.folder, ".dl621_verified")))
+
+    def test_skip_existing_with_manifest(self):
+        with mock.patch("os.setxattr", side_effect=OSError), mock.patch("os.getxattr", side_effect=OSError):
+            self.check_skip_existing()
+        self.assertTrue(os.path.exists(os.path.join(self.folder, ".dl621_verified")))
+
+
+class VariantTestSuite(unittest.TestCase):
+    """Sample and preview downloads."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=5, file_size=4096).start()
+        self.client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None, retry_policy=dl621.RetryPolicy(max_attempts=2, backoff_base=0))
+        self.folder = tempfile.mkdtemp()
+
+        # The mock has no samples or previews, so post 1 gets both, post 2 a sample of the original like e621 sends, and post 3 nothing
+        for post_id in range(1, 6):
+            md5 = self.mock.posts[post_id]["file"]["md5"]
+            self.mock.files["sample_" + md5] = make_png(100 + post_id, 1024)
+            self.mock.files["preview_" + md5] = make_png(200 + post_id, 256)
+        get_post = self.mock.get_post
+
+        def get_post_with_variants(post_id):
+            post = get_post(post_id)
+            md5 = post["file"]["md5"]
+            if post_id == 1:
+                post["sample"] = {"has": True, "width": 1, "height": 1, "url": "{}data/sample_{}.jpg".format(self.mock.base_url, md5)}
+                post["preview"]["url"] = "{}data/preview_{}.jpg".format(self.mock.base_url, md5)
+            elif post_id == 2:
+                post["sample"] = {"has": False, "width": 1, "height": 1, "url": post["file"]["url"]}
+            return post
+
+        self.mock.get_post = get_post_with_variants
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def download(self, post_id, variant, **kwargs):
+        return self.client.download_image(post_id, output_folder=self.folder, name_pattern="{i}", add_tags=False, variant=variant, **kwargs)
+
+    def read_file(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_sample_and_preview(self):
+        md5 = self.mock.posts[1]["file"]["md5"]
+        for variant in ["sample", "preview"]:
+            results = self.download(1, variant)
+            self.assertEqual(results["variant"], variant)
+            self.assertEqual(results["path_image"], os.path.join(self.folder, "1_{}.jpg".format(variant)))
+            self.assertEqual(self.read_file(results["path_image"]), self.mock.files["{}_{}".format(variant, md5)])
+
+    def test_sample_of_the_original_falls_back(self):
+        results = self.download(2, "sample")
+        self.assertEqual(results["variant"], "file")
+        self.assertEqual(results["path_image"], os.path.join(self.folder, "2.png"))
+        self.assertEqual(self.read_file(results["path_image"]), self.mock.files[self.mock.posts[2]["file"]["md5"]])
+
+    def test_missing_variant_falls_back(self):
+        for variant in ["sample", "preview"]:
+            results = self.download(3, variant)
+            self.assertEqual(results["variant"], "file")
+            self.assertTrue(results["saved_image"])
+        self.assertEqual(os.listdir(self.folder), ["3.png"])
+
+    def test_variant_is_charged_for_received_bytes(self):
+        scheduler = dl621.Scheduler(byte_budget=10 ** 9)
+        self.assertTrue(self.download(1, "sample", scheduler=scheduler)["saved_image"])
+        self.assertEqual(scheduler.bytes_reserved, len(self.mock.files["sample_" + self.mock.posts[1]["file"]["md5"]]))
+
+
+class TimingTestSuite(unittest.TestCase):
+    """Download stage timings."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=5, file_size=1024).start()
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def test_waits_are_not_counted_as_first_byte(self):
+        client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=dl621.RateLimiter(2, burst=1), retry_policy=dl621.RetryPolicy(max_attempts=3, backoff_base=0.5, jitter=0))
+        failures = [True]
+        self.mock.should_fail = lambda: len(failures) > 0 and failures.pop()
+        results = client.download_image(1, custom_json=self.mock.get_post(1), output_folder=self.folder, add_tags=False)
+
+        # The server asks for no delay, so the retry only waits for its turn with the limiter
+        timings = results["timings"]
+        self.assertTrue(results["saved_image"])
+        self.assertGreater(timings["rate_limit"], 0.3)
+        self.assertLess(timings["first_byte"], 0.3)
+        self.assertIn("retry_wait", timings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Cumulative microseconds "import dl621" may take, as measured by python -X importtime
+IMPORT_TIME_BUDGET = 50000
+
+# Modules that must only be loaded once they are needed
+LAZY_MODULES = ["requests", "urllib3", "imgtag", "libxmp", "argparse", "concurrent.futures", "sqlite3", "email.utils"]
+
+
+def measure_import(statement="import dl621"):
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=PACKAGE_ROOT, env=env, capture_output=True, text=True, check=True)
+
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+class ImportTimeTestSuite(unittest.TestCase):
+    """Import time budget."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Measure warm imports, not the one-off cost of compiling the package
+        subprocess.run([sys.executable, "-m", "compileall", "-q", os.path.join(PACKAGE_ROOT, "dl621")], check=True)
+
+    def test_heavy_modules_are_lazy(self):
+        times = measure_import()
+        self.assertIn("dl621", times)
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, times, "{} is imported by 'import dl621'".format(name))
+
+    def test_import_time_budget(self):
+        # Best of a few runs, so a busy machine doesn't fail the test
+        best = min(measure_import()["dl621"] for i in range(5))
+        self.assertLess(best, IMPORT_TIME_BUDGET, "'import dl621' took {} us".format(best))
+
+    def test_cli_help_is_lazy(self):
+        times = measure_import("import sys, dl621.core; sys.argv = ['dl621', '-h']\ntry:\n    dl621.core.run()\nexcept SystemExit:\n    pass")
+        for name in ["requests", "imgtag"]:
+            self.assertNotIn(name, times, "{} is imported by 'dl621 -h'".format(name))
+
+
+if __name__ == '__main__':
+    unittest.main()
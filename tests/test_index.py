@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import array
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+sys.path.insert(0, os.path.join(PACKAGE_ROOT, "benchmarks"))
+
+import dl621
+from dl621.index import merge_post_ids, intersect_post_ids, parse_query
+from mock_e621 import MockE621
+
+
+class PostIdListTestSuite(unittest.TestCase):
+    """Sorted post ID lists."""
+
+    def test_merge_appends_newer_posts(self):
+        post_ids = array.array("I", [1, 5, 9])
+        merged = merge_post_ids(post_ids, [12, 10], set())
+        self.assertEqual(list(merged), [1, 5, 9, 10, 12])
+
+    def test_merge_adds_and_removes(self):
+        post_ids = array.array("I", [1, 5, 9])
+        self.assertEqual(list(merge_post_ids(post_ids, [3, 5], {9})), [1, 3, 5])
+        self.assertEqual(list(merge_post_ids(array.array("I"), [], set())), [])
+        self.assertEqual(list(merge_post_ids(array.array("I", [4]), [], {4})), [])
+
+    def test_intersect(self):
+        small = array.array("I", [3, 50, 700])
+        large = array.array("I", range(0, 1000, 2))
+        self.assertEqual(list(intersect_post_ids(small, large)), [50, 700])
+        self.assertEqual(list(intersect_post_ids(large, small)), [50, 700])
+        self.assertEqual(list(intersect_post_ids(array.array("I", [1, 2, 3]), array.array("I", [2, 3, 4]))), [2, 3])
+        self.assertEqual(list(intersect_post_ids(array.array("I"), large)), [])
+
+    def test_parse_query(self):
+        self.assertEqual(parse_query("wolf ~red ~blue -fox rating:s"), (["wolf", "rating:s"], ["red", "blue"], ["fox"]))
+        self.assertEqual(parse_query("- ~"), (["-", "~"], [], []))
+
+
+class TagIndexTestSuite(unittest.TestCase):
+    """Tag index queries."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.index = dl621.TagIndex(os.path.join(self.folder, "index.sqlite"), flush_every=3)
+        self.index.add(1, ["wolf", "red", "rating: s"], path="1.png")
+        self.index.add(2, ["wolf", "blue", "rating: e"], path="2.png")
+        self.index.add(3, ["fox", "red", "rating: s"], path="3.png")
+        self.index.add(4, ["fox", "green", "rating: q"], path="4.png")
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.folder)
+
+    def test_and(self):
+        self.assertEqual(self.index.search("wolf"), [1, 2])
+        self.assertEqual(self.index.search("wolf red"), [1])
+        self.assertEqual(self.index.search("wolf fox"), [])
+        self.assertEqual(self.index.search("missing"), [])
+
+    def test_or(self):
+        self.assertEqual(self.index.search("~blue ~green"), [2, 4])
+        self.assertEqual(self.index.search("red ~wolf ~green"), [1])
+
+    def test_not(self):
+        self.assertEqual(self.index.search("-wolf"), [3, 4])
+        self.assertEqual(self.index.search("red -fox"), [1])
+        self.assertEqual(self.index.search("~wolf ~fox -red -green"), [2])
+
+    def test_rating_shorthand(self):
+        self.assertEqual(self.index.search("rating:s"), [1, 3])
+        self.assertEqual(self.index.query(all_tags=["rating: s"]), [1, 3])
+
+    def test_retag_and_remove(self):
+        self.index.add(1, ["wolf", "green"], path="1.png")
+        self.index.remove(3)
+        self.assertEqual(self.index.search("red"), [])
+        self.assertEqual(self.index.search("green"), [1, 4])
+        self.assertEqual(len(self.index), 3)
+        self.assertNotIn(3, self.index)
+        self.assertEqual(self.index.get_paths([1, 2]), {1: "1.png", 2: "2.png"})
+
+    def test_survives_reopening(self):
+        self.index.close()
+        self.index = dl621.TagIndex(os.path.join(self.folder, "index.sqlite"))
+        self.assertEqual(self.index.search("red -wolf"), [3])
+
+    def test_matches_brute_force(self):
+        mock = MockE621(posts=300, file_size=64)
+        posts = dict((post_id, set(dl621.get_tags_from_json(post))) for post_id, post in mock.posts.items())
+        index = dl621.TagIndex(os.path.join(self.folder, "mock.sqlite"))
+        for post_id, tags in posts.items():
+            index.add(post_id, tags)
+
+        def brute_force(all_tags, any_tags, no_tags):
+            # "rating:s" in a query is the "rating: s" tag
+            all_tags, any_tags, no_tags = [[tag.replace(":", ": ", 1) for tag in tags] for tags in (all_tags, any_tags, no_tags)]
+            found = list()
+            for post_id, tags in sorted(posts.items()):
+                if all(tag in tags for tag in all_tags) and (len(any_tags) == 0 or any(tag in tags for tag in any_tags)) and not any(tag in tags for tag in no_tags):
+                    found.append(post_id)
+            return found
+
+        for query in ["tag_1", "tag_1 tag_2", "~tag_1 ~tag_2", "rating:s -tag_4", "~rating:q ~rating:e -tag_3 -tag_7", "tag_5 ~tag_6 ~tag_8 -tag_9"]:
+            all_tags, any_tags, no_tags = parse_query(query)
+            self.assertEqual(index.search(query), brute_force(all_tags, any_tags, no_tags), query)
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
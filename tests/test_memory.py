@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+
+import dl621
+
+
+class MemoryGovernorTestSuite(unittest.TestCase):
+    """Memory governor admission."""
+
+    def setUp(self):
+        self.governor = dl621.MemoryGovernor(budget=100)
+        self.admitted = list()
+        self.threads = list()
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def start_job(self, name, amount, hold=None):
+        # Jobs queue up one at a time, so the order they asked in is known
+        waiting = len(self.governor.queue)
+
+        def job():
+            with self.governor.reserve(amount):
+                self.admitted.append(name)
+                if hold != None:
+                    hold.wait(5)
+
+        thread = threading.Thread(target=job)
+        thread.start()
+        self.threads.append(thread)
+        self.wait_for(lambda: len(self.governor.queue) > waiting or name in self.admitted)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_admitted_in_order(self):
+        release = threading.Event()
+        self.start_job("first", 60, hold=release)
+        self.start_job("big", 80)
+
+        # The small job would fit next to the first one, but it doesn't jump the queue
+        self.start_job("small", 10)
+        time.sleep(0.1)
+        self.assertEqual(self.admitted, ["first"])
+
+        release.set()
+        self.wait_for(lambda: len(self.admitted) == 3)
+        self.assertEqual(self.admitted, ["first", "big", "small"])
+
+    def test_job_bigger_than_budget_runs_alone(self):
+        release = threading.Event()
+        self.start_job("huge", 150, hold=release)
+        self.start_job("small", 1)
+        time.sleep(0.1)
+        self.assertEqual(self.admitted, ["huge"])
+
+        release.set()
+        self.wait_for(lambda: len(self.admitted) == 2)
+        self.assertEqual(self.governor.used, 0)
+
+    def test_budget_is_never_exceeded(self):
+        rng = random.Random(621)
+
+        def job(amount):
+            with self.governor.reserve(amount):
+                time.sleep(0.001)
+
+        for i in range(50):
+            thread = threading.Thread(target=job, args=(rng.randrange(1, 60),))
+            thread.start()
+            self.threads.append(thread)
+        for thread in self.threads:
+            thread.join(5)
+        self.assertLessEqual(self.governor.peak, 100)
+        self.assertEqual(self.governor.used, 0)
+
+    def test_process_limit_is_opt_in(self):
+        limit = resource.getrlimit(resource.RLIMIT_AS)
+        dl621.MemoryGovernor(budget=100)
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_AS), limit)
+
+
+if __name__ == '__main__':
+    unittest.main()
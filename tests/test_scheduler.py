@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+sys.path.insert(0, os.path.join(PACKAGE_ROOT, "benchmarks"))
+
+import dl621
+from mock_e621 import MockE621
+
+
+class ByteBudgetTestSuite(unittest.TestCase):
+    """Byte budget reservations and settlement."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=10, file_size=4096).start()
+        self.client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None, retry_policy=dl621.RetryPolicy(max_attempts=2, backoff_base=0))
+        self.folder = tempfile.mkdtemp()
+        self.posts = [self.mock.get_post(post_id) for post_id in range(1, 11)]
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def download(self, scheduler, posts=None, **kwargs):
+        return self.client.download_images(posts or self.posts, output_folder=self.folder, name_pattern="{i}", add_tags=False, scheduler=scheduler, **kwargs)
+
+    def test_budget_settles_to_received_bytes(self):
+        scheduler = dl621.Scheduler(byte_budget=10 ** 9)
+        results = self.download(scheduler, workers=4)
+        self.assertTrue(all(r["saved_image"] for r in results))
+        self.assertEqual(scheduler.bytes_reserved, self.mock.stats["file_bytes"])
+        self.assertEqual(scheduler.bytes_reserved, sum(post["file"]["size"] for post in self.posts))
+
+    def test_resumed_transfer_is_charged_for_the_rest(self):
+        post = self.posts[0]
+        with open(os.path.join(self.folder, "1.png.part"), "wb") as f:
+            f.write(self.mock.files[post["file"]["md5"]][:1000])
+
+        scheduler = dl621.Scheduler(byte_budget=10 ** 9)
+        self.assertTrue(self.download(scheduler, posts=[post])[0]["saved_image"])
+        self.assertEqual(scheduler.bytes_reserved, post["file"]["size"] - 1000)
+
+    def test_failed_transfer_is_refunded(self):
+        post = self.posts[0]
+        self.mock.files.pop(post["file"]["md5"])
+        scheduler = dl621.Scheduler(byte_budget=10 ** 9)
+        self.assertNotEqual(self.download(scheduler, posts=[post])[0]["error"], "")
+        self.assertEqual(scheduler.bytes_reserved, 0)
+
+    def test_budget_stops_downloads(self):
+        budget = sum(post["file"]["size"] for post in self.posts[:3])
+        scheduler = dl621.Scheduler(byte_budget=budget)
+        results = self.download(scheduler, workers=1)
+
+        # Posts are charged in full before they start, so the budget is never overrun
+        self.assertEqual([r["post_id"] for r in results if r["saved_image"]], [1, 2, 3])
+        self.assertTrue(all("ByteBudgetError" in r["error"] for r in results[3:]))
+        self.assertEqual(self.mock.stats["file_bytes"], budget)
+        self.assertEqual(scheduler.bytes_reserved, budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+sys.path.insert(0, os.path.join(PACKAGE_ROOT, "benchmarks"))
+
+import dl621
+from mock_e621 import MockE621
+
+
+class ContentStoreTestSuite(unittest.TestCase):
+    """Content store downloads and locks."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=5, file_size=1024).start()
+        self.client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None)
+        self.folder = tempfile.mkdtemp()
+        self.store = dl621.ContentStore(os.path.join(self.folder, "store"))
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def test_each_file_is_downloaded_once(self):
+        for name in ["a", "b"]:
+            results = self.client.download_images([1, 2, 3], output_folder=os.path.join(self.folder, name), name_pattern="{i}", add_tags=False, store=self.store)
+            self.assertTrue(all(r["saved_image"] for r in results))
+        self.assertEqual(self.mock.stats["file_requests"], 3)
+        self.assertTrue(os.path.samefile(os.path.join(self.folder, "a", "1.png"), os.path.join(self.folder, "b", "1.png")))
+
+    def test_lock_files_are_removed(self):
+        self.client.download_images([1, 2, 3], output_folder=self.folder, add_tags=False, store=self.store)
+        with self.store.lock(self.store.get_object_path("0" * 32, "png")):
+            pass
+
+        lock_files = list()
+        for folder, folders, files in os.walk(self.store.root):
+            lock_files += [name for name in files if name.endswith(".lock")]
+        self.assertEqual(lock_files, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+sys.path.insert(0, os.path.join(PACKAGE_ROOT, "benchmarks"))
+
+import dl621
+from mock_e621 import MockE621
+
+TAGS = "sync_test"
+
+
+class SyncTestSuite(unittest.TestCase):
+    """Incremental sync high-water marks."""
+
+    def setUp(self):
+        self.mock = MockE621(posts=20, file_size=1024).start()
+        self.client = dl621.Client(base_url=self.mock.base_url, api_rate_limit=None, file_rate_limit=None)
+        self.folder = tempfile.mkdtemp()
+        self.state = dl621.SyncState(os.path.join(self.folder, "sync.sqlite"))
+
+    def tearDown(self):
+        self.state.close()
+        self.mock.stop()
+        shutil.rmtree(self.folder)
+
+    def sync(self, **kwargs):
+        return self.client.sync(TAGS, self.state, output_folder=self.folder, add_tags=False, workers=2, **kwargs)
+
+    def test_high_water_advances(self):
+        results = self.sync(limit=5)
+        self.assertEqual([r["post_id"] for r in results], [1, 2, 3, 4, 5])
+        self.assertEqual(self.state.get_high_water(TAGS), 5)
+
+        results = self.sync()
+        self.assertEqual([r["post_id"] for r in results], list(range(6, 21)))
+        self.assertEqual(self.state.get_high_water(TAGS), 20)
+
+        # Nothing new, so nothing is downloaded
+        self.assertEqual(self.sync(), [])
+        self.assertEqual(self.state.get_high_water(TAGS), 20)
+
+    def test_high_water_stops_before_failed_post(self):
+        missing = self.mock.posts[8]["file"]["md5"]
+        data = self.mock.files.pop(missing)
+
+        results = self.sync()
+        failed = [r["post_id"] for r in results if r["error"] != ""]
+        self.assertEqual(failed, [8])
+        self.assertEqual(self.state.get_high_water(TAGS), 7)
+
+        # The next run starts again from the failed post
+        self.mock.files[missing] = data
+        results = self.sync(skip_existing=True)
+        self.assertEqual(results[0]["post_id"], 8)
+        self.assertTrue(all(r["error"] == "" for r in results))
+        self.assertEqual(self.state.get_high_water(TAGS), 20)
+
+    def test_high_water_passes_journaled_posts_on_resume(self):
+        journal = dl621.Journal(os.path.join(self.folder, "journal.sqlite"))
+        missing = self.mock.posts[2]["file"]["md5"]
+        data = self.mock.files.pop(missing)
+        self.sync(journal=journal, resume=True)
+        self.assertEqual(self.state.get_high_water(TAGS), 1)
+
+        # Posts the journal already has are skipped, but the mark still moves past them
+        self.mock.files[missing] = data
+        results = self.sync(journal=journal, resume=True)
+        self.assertEqual([r["post_id"] for r in results], [2])
+        self.assertEqual(self.state.get_high_water(TAGS), 20)
+        journal.close()
+
+    def test_high_water_after_interrupted_sync(self):
+        sync = self.client.iter_sync(TAGS, self.state, output_folder=self.folder, add_tags=False, workers=2)
+        for i, results in enumerate(sync):
+            if i == 2:
+                break
+        sync.close()
+
+        # Posts that were still in flight when the run stopped don't count
+        self.assertEqual(self.state.get_high_water(TAGS), 3)
+
+    def test_recheck_downloads_changed_posts(self):
+        self.sync()
+        self.mock.posts[18]["tags"]["general"].append("new_tag")
+        self.mock.posts[19]["flags"]["deleted"] = True
+
+        results = self.sync(recheck=5)
+        changed = dict((r["post_id"], r) for r in results)
+        self.assertEqual(sorted(changed), [18, 19])
+        self.assertTrue(changed[18]["saved_image"])
+        self.assertTrue(changed[19]["post_deleted"])
+
+        # Once recorded, the same posts aren't changed any more
+        self.assertEqual(self.sync(recheck=5), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+PACKAGE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PACKAGE_ROOT)
+sys.path.insert(0, os.path.join(PACKAGE_ROOT, "benchmarks"))
+
+import dl621
+from mock_e621 import MockE621
+
+
+def get_tags_from_json_reference(info_json):
+    # The implementation before the fast path, kept here to check the output doesn't change
+    post_id = info_json["id"]
+    tags_src_obj = info_json["tags"]
+
+    tags_out = list()
+    for tag_cat in tags_src_obj.keys():
+        tags_in_cat = tags_src_obj[tag_cat]
+        for curr_tag in tags_in_cat:
+            if tag_cat == "general":
+                tags_out.append(curr_tag)
+            else:
+                tags_out.append("{}: {}".format(tag_cat, curr_tag))
+
+    parent = info_json["relationships"]["parent_id"]
+    children = info_json["relationships"]["children"]
+    if parent != None:
+        tags_out.append("post_parent: {}".format(parent))
+    if len(children) > 0:
+        for child in children:
+            tags_out.append("post_child: {}".format(child))
+
+    tags_out.append("post_site: e621.net")
+    tags_out.append("post_id: {}".format(post_id))
+    tags_out.append("md5: {}".format(info_json["file"]["md5"]))
+    tags_out.append("rating: {}".format(info_json["rating"]))
+    for pool in info_json["pools"]:
+        tags_out.append("pool: {}".format(pool))
+    for source in info_json["sources"]:
+        tags_out.append("source: {}".format(source))
+    return tags_out
+
+
+class TagConversionTestSuite(unittest.TestCase):
+    """Tag lists built from post JSON."""
+
+    def setUp(self):
+        mock = MockE621(posts=200, file_size=64)
+        self.posts = [mock.posts[post_id] for post_id in sorted(mock.posts)]
+
+        # Cover the parts the mock leaves empty
+        self.posts[0]["relationships"]["children"] = [5, 17]
+        self.posts[1]["pools"] = [12, 3400]
+        self.posts[2]["tags"]["character"] = ["renamon", "ünïcödé_tag"]
+        self.posts[2]["tags"]["custom_category"] = ["x"]
+        self.posts[3]["tags"] = dict((tag_cat, []) for tag_cat in self.posts[3]["tags"])
+        self.posts[3]["sources"] = []
+
+    def test_matches_reference(self):
+        for post in self.posts:
+            self.assertEqual(dl621.get_tags_from_json(post), get_tags_from_json_reference(post), post["id"])
+
+    def test_batch_matches_reference(self):
+        self.assertEqual(dl621.get_tags_from_json_batch(self.posts), [get_tags_from_json_reference(post) for post in self.posts])
+
+    def test_structured_flattens_to_reference(self):
+        for post in self.posts:
+            structured = dl621.get_tags_from_json(post, structured=True)
+            self.assertEqual(dl621.flatten_tags(structured), get_tags_from_json_reference(post), post["id"])
+        structured = dl621.get_tags_from_json_batch(self.posts, structured=True)
+        self.assertEqual([dl621.flatten_tags(tags) for tags in structured], [get_tags_from_json_reference(post) for post in self.posts])
+
+
+if __name__ == '__main__':
+    unittest.main()